@@ -1,20 +1,12 @@
-import os
 import fitz  # PyMuPDF for PDF text extraction
-import google.generativeai as genai
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Load Gemini API Key
-api_key = os.getenv("GOOGLE_API_KEY")
-if not api_key:
-    raise ValueError("❌ GOOGLE_API_KEY is missing from .env file!")
-
-print("✅ API Key Loaded Successfully!")
-
-# Configure Gemini API
-genai.configure(api_key=api_key)
+# LLM calls go through the backend's shared gateway (quotas, retries, circuit breaker),
+# which also reads GOOGLE_API_KEY; see readme.md for putting the backend on PYTHONPATH
+from llm_gateway import generate
 
 # Function to extract text from the academic calendar PDF
 def extract_text_from_pdf(pdf_path):
@@ -33,8 +25,6 @@ def format_calendar_with_gemini(extracted_text):
     if not extracted_text:
         return "⚠ No valid extracted text available from the academic calendar."
 
-    model = genai.GenerativeModel("gemini-1.5-flash")
-
     prompt = f""" 
     You are an expert in structuring academic data. Given the extracted text from a university academic calendar, your task is to:
     
@@ -49,7 +39,7 @@ def format_calendar_with_gemini(extracted_text):
     {extracted_text}
     """
 
-    response = model.generate_content(prompt)
+    response = generate(prompt)
     return response.text if response else "⚠ Error: No response from Gemini AI."
 
 # File path for the academic calendar PDF (Update as per your system)
@@ -1,22 +1,14 @@
 import easyocr
 import numpy as np
-import google.generativeai as genai
 from pdf2image import convert_from_path
 from dotenv import load_dotenv
-import os
 
 # Load environment variables
 load_dotenv()
 
-# Load Gemini API Key
-api_key = os.getenv("GOOGLE_API_KEY")
-if not api_key:
-    raise ValueError("❌ GOOGLE_API_KEY is missing from .env file!")
-
-print("✅ API Key Loaded Successfully!")
-
-# Configure Gemini API
-genai.configure(api_key=api_key)
+# LLM calls go through the backend's shared gateway (quotas, retries, circuit breaker),
+# which also reads GOOGLE_API_KEY; see readme.md for putting the backend on PYTHONPATH
+from llm_gateway import generate
 
 # Load OCR model
 reader = easyocr.Reader(['en'])
@@ -43,8 +35,6 @@ def format_exam_schedule_with_gemini(extracted_text):
     if not extracted_text.strip():
         return "⚠ No valid extracted text available from the academic calendar."
 
-    model = genai.GenerativeModel("gemini-1.5-flash")
-
     prompt = f"""
 You are an expert in structuring academic exam schedules. Given the extracted text from a university exam schedule, your task is to:
 
@@ -64,7 +54,7 @@ You are an expert in structuring academic exam schedules. Given the extracted te
 
 Now, generate a well-formatted table with this information.
 """
-    response = model.generate_content(prompt)
+    response = generate(prompt)
     return response.text if response else "⚠ Error: No response from Gemini AI."
 
 # 🔹 Generate formatted output
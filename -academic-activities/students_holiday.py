@@ -1,13 +1,14 @@
 import fitz  # PyMuPDF
 import easyocr
-import os
-import requests
 import json
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+
+# LLM calls go through the backend's shared gateway (quotas, retries, circuit breaker),
+# which also reads GROQ_API_KEY; see readme.md for putting the backend on PYTHONPATH
+from llm_gateway import generate, LLMGatewayError, ProviderHTTPError
 
 # Initialize EasyOCR Reader
 reader = easyocr.Reader(["en"])  # Add other languages if needed
@@ -39,28 +40,19 @@ def extract_text_from_pdf(pdf_path):
 def process_with_groq(text):
     print("🤖 Sending text to Groq for processing...")
 
-    GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json"
-    }
-
-    data = {
-        "model": "llama-3.3-70b-versatile",
-        "messages": [
-            {"role": "system", "content": "You are an AI assistant that extracts structured holiday lists."},
-            {"role": "user", "content": f"Extract and format a structured holiday list from the following and PRESENT IN A TABULAR FORMAT WHICH IS MUST:\n\n{text}"}
-        ],
-        "temperature": 0.5,
-        "max_tokens": 1024
-    }
+    try:
+        response = generate(
+            f"Extract and format a structured holiday list from the following and PRESENT IN A TABULAR FORMAT WHICH IS MUST:\n\n{text}",
+            provider="groq",
+            model="llama-3.3-70b-versatile",
+            system="You are an AI assistant that extracts structured holiday lists.",
+            temperature=0.5,
+            max_tokens=1024,
+        )
+    except (LLMGatewayError, ProviderHTTPError) as e:
+        return f"⚠ API Error: {e}"
 
-    response = requests.post(GROQ_API_URL, headers=headers, json=data)
-
-    if response.status_code == 200:
-        return response.json().get("choices", [{}])[0].get("message", {}).get("content", "⚠ Error: No response from Groq.")
-    else:
-        return f"⚠ API Error: {response.status_code} - {response.text}"
+    return response.text or "⚠ Error: No response from Groq."
 
 # PDF File Path
 holiday_pdf_path = r"C:\Users\AmanDeep\OneDrive\Desktop\AI-Agents-KiiT-Management\-academic-activities\holiday.pdf"
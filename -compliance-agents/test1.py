@@ -1,11 +1,15 @@
 import os
 import base64
+from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify', 'https://www.googleapis.com/auth/gmail.send']
+QUERY = 'subject:"WIFI RESET" -in:sent'
+HISTORY_FILE = 'history_id.txt'   # Gmail historyId the last sync got up to
+BATCH_SIZE = 100                  # Gmail accepts at most 100 calls per batch request
 
 
 def authenticate_gmail():
@@ -42,29 +46,126 @@ def get_email_body(payload):
     return "No body content found."
 
 
-def send_acknowledgment(service, recipient):
-    message = {
+def build_acknowledgment(recipient):
+    return {
         'raw': base64.urlsafe_b64encode(
             f"From: me\nTo: {recipient}\nSubject: Acknowledgment - WIFI RESET\n\nYour email has been acknowledged! Here's a test reset code: 123456"
             .encode("utf-8")
         ).decode("utf-8")
     }
-    service.users().messages().send(userId='me', body=message).execute()
-    print(f"Acknowledgment sent to {recipient}")
 
 
-def fetch_wifi_reset_emails(service):
-    results = service.users().messages().list(userId='me', q='subject:"WIFI RESET" -in:sent').execute()
-    messages = results.get('messages', [])
+def send_acknowledgment(service, recipients):
+    # One batch request per BATCH_SIZE replies instead of one HTTP round trip per sender
+    # Batch ids must be unique and one sender can have several requests, so use the position
+    def on_sent(request_id, response, exception):
+        recipient = recipients[int(request_id)]
+        if exception is not None:
+            print(f"Failed to send acknowledgment to {recipient}: {exception}")
+        else:
+            print(f"Acknowledgment sent to {recipient}")
+
+    for start in range(0, len(recipients), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_sent)
+        for i in range(start, min(start + BATCH_SIZE, len(recipients))):
+            batch.add(service.users().messages().send(userId='me', body=build_acknowledgment(recipients[i])), request_id=str(i))
+        batch.execute()
+
+
+def load_history_id():
+    if os.path.exists(HISTORY_FILE):
+        with open(HISTORY_FILE) as f:
+            return f.read().strip() or None
+    return None
+
+
+def save_history_id(history_id):
+    with open(HISTORY_FILE, 'w') as f:
+        f.write(str(history_id))
+
+
+def list_message_ids(service, query):
+    """Page through messages().list and return every matching message id."""
+    ids = []
+    request = service.users().messages().list(userId='me', q=query, maxResults=500)
+    while request is not None:
+        results = request.execute()
+        ids.extend(msg['id'] for msg in results.get('messages', []))
+        request = service.users().messages().list_next(request, results)
+    return ids
+
+
+def list_added_message_ids(service, start_history_id):
+    """
+    Return (message ids added since start_history_id, latest historyId).
+
+    Returns (None, None) when the stored historyId has expired and a full sync is needed.
+    """
+    ids = []
+    history_id = start_history_id
+    request = service.users().history().list(
+        userId='me', startHistoryId=start_history_id, historyTypes='messageAdded', maxResults=500
+    )
+    try:
+        while request is not None:
+            results = request.execute()
+            history_id = results.get('historyId', history_id)
+            for record in results.get('history', []):
+                ids.extend(added['message']['id'] for added in record.get('messagesAdded', []))
+            request = service.users().history().list_next(request, results)
+    except HttpError as e:
+        if e.resp.status == 404:
+            return None, None
+        raise
+    return list(dict.fromkeys(ids)), history_id
+
+
+def get_messages(service, ids):
+    """Fetch full messages in batches of BATCH_SIZE, returned in the order of `ids`."""
+    messages = {}
+
+    def on_message(request_id, response, exception):
+        if exception is not None:
+            print(f"Failed to fetch message {request_id}: {exception}")
+        else:
+            messages[request_id] = response
+
+    for start in range(0, len(ids), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_message)
+        for msg_id in ids[start:start + BATCH_SIZE]:
+            batch.add(service.users().messages().get(userId='me', id=msg_id), request_id=msg_id)
+        batch.execute()
+    return [messages[msg_id] for msg_id in ids if msg_id in messages]
+
 
+def is_wifi_reset(message):
+    # history.list can't filter by query, so apply QUERY's conditions here
+    if 'SENT' in message.get('labelIds', []):
+        return False
+    for header in message['payload']['headers']:
+        if header['name'] == 'Subject':
+            return 'WIFI RESET' in header['value'].upper()
+    return False
+
+
+def fetch_wifi_reset_emails(service):
+    history_id = load_history_id()
+    ids = None
+    if history_id:
+        ids, latest_history_id = list_added_message_ids(service, history_id)
+        if ids is None:
+            print("Stored historyId expired, doing a full sync.")
+    if ids is None:
+        # Take the historyId before listing so nothing arriving mid-sync is missed
+        latest_history_id = service.users().getProfile(userId='me').execute()['historyId']
+        ids = list_message_ids(service, QUERY)
+
+    messages = [message for message in get_messages(service, ids) if is_wifi_reset(message)]
     if not messages:
         print("No WIFI RESET emails found.")
-        return
-
-    for msg in messages:
-        msg_id = msg['id']
-        message = service.users().messages().get(userId='me', id=msg_id).execute()
 
+    recipients = []
+    for message in messages:
         payload = message['payload']
         headers = payload['headers']
         sender = None
@@ -79,7 +180,10 @@ def fetch_wifi_reset_emails(service):
         print(f"Email content: {body}")
 
         if sender:
-            send_acknowledgment(service, sender)
+            recipients.append(sender)
+
+    send_acknowledgment(service, recipients)
+    save_history_id(latest_history_id)
 
 
 if __name__ == "__main__":
@@ -8,6 +8,7 @@ from agno.vectordb.lancedb import LanceDb, SearchType
 from dotenv import load_dotenv
 from fastapi import APIRouter
 from pydantic import BaseModel
+from async_io import run_blocking
 
 load_dotenv()
 
@@ -111,5 +112,5 @@ class BotRequest(BaseModel):
 @router.post("/bot")
 async def get_bot_response(request: BotRequest):
     user_message = request.message
-    response_text = ask_agent(user_message)
+    response_text = await run_blocking(ask_agent, user_message)
     return {"response": response_text}
@@ -0,0 +1,93 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+IO_THREADS       = int(os.environ.get("IO_THREADS", "16"))          # worker threads for blocking IMAP/SMTP/SQLite calls
+LLM_CONCURRENCY  = int(os.environ.get("LLM_CONCURRENCY", "8"))      # Gemini calls in flight per request
+LLM_CALL_TIMEOUT = float(os.environ.get("LLM_CALL_TIMEOUT", "30"))  # seconds before one extraction is given up on
+
+# Set in the I/O pool's workers, which must never wait on the event loop (see run_coroutine)
+_worker = threading.local()
+
+
+def _mark_worker():
+    _worker.in_pool = True
+
+
+# Separate from the default executor so a slow mailbox can't starve other to_thread users
+_executor = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="blocking-io", initializer=_mark_worker)
+
+# The app's event loop, once it is running (see use_event_loop)
+_loop = None
+
+
+def use_event_loop(loop):
+    """Have run_coroutine schedule onto `loop`; called once the app's event loop is running."""
+    global _loop
+    _loop = loop
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call (imaplib, smtplib, sqlite3, ...) on the I/O thread pool and await its result."""
+    loop = asyncio.get_running_loop()
+    # Carry context variables (e.g. metrics.current_router) into the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+def run_coroutine(coro):
+    """
+    Run a coroutine to completion from synchronous code (e.g. a scan finish() hook) and return its result.
+
+    While the app is up the coroutine runs on its event loop, so its run_blocking calls share the
+    one I/O pool with the requests. An I/O pool worker can't wait for it there: once every worker
+    is waiting, the work queued behind them never runs, so that is refused rather than deadlocking.
+    """
+    if _loop is None or _loop.is_closed():
+        # No app (scripts, benchmarks): this thread can run a loop of its own
+        return asyncio.run(coro)
+    if getattr(_worker, "in_pool", False):
+        coro.close()
+        raise RuntimeError("run_coroutine called from an I/O pool worker; await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+
+async def map_bounded(func, items, limit=LLM_CONCURRENCY, timeout=LLM_CALL_TIMEOUT, default=None, reraise=()):
+    """
+    Await func(item) for every item with at most `limit` running at once.
+
+    Results come back in the order of `items`; an item that takes longer than
+    `timeout` seconds (once started) or raises yields `default` instead, so one bad
+    item never fails the batch. Exceptions of the types in `reraise` still propagate
+    (e.g. LLMUnavailableError, so the caller can defer the whole batch).
+    """
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run_one(index, item):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(func(item), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Item {index} timed out after {timeout}s")
+                return default
+            except reraise:
+                raise
+            except Exception as e:
+                logger.error(f"Item {index} failed: {str(e)}")
+                return default
+
+    return await asyncio.gather(*(run_one(i, item) for i, item in enumerate(items)))
+
+
+def shutdown_blocking_io():
+    use_event_loop(None)
+    _executor.shutdown(wait=False)
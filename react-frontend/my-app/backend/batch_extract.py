@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+from dotenv import load_dotenv
+
+import llm_cache
+from async_io import run_blocking, map_bounded
+from llm_gateway import generate_async, LLMUnavailableError
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+EXTRACT_BATCH_SIZE = int(os.environ.get("EXTRACT_BATCH_SIZE", "10"))   # emails packed into one Gemini prompt
+BATCH_PROMPT_VERSION = "batch-v1"   # bump when the prompt changes so cached extractions are not reused
+
+FIELDS = ("name", "roll_number", "from_date", "to_date", "pronoun", "cgpa")
+
+
+def build_batch_prompt(email_texts):
+    emails = "\n\n".join(f"--- Email {i} ---\n{text}" for i, text in enumerate(email_texts))
+    keys = ", ".join(f'"{field}"' for field in ("index",) + FIELDS)
+    return (
+        f"You are given {len(email_texts)} emails from students, numbered from 0.\n"
+        f"Return only a JSON array with exactly {len(email_texts)} objects, one per email and in the same order, "
+        f"each with the keys {keys}.\n"
+        "Use null for anything the email does not mention. pronoun is \"his\", \"her\" or \"their\".\n\n"
+        f"{emails}"
+    )
+
+
+def parse_batch_response(text, count):
+    """Return `count` dicts (keyed by FIELDS) from the model's JSON array, or raise ValueError."""
+    start, end = text.find("["), text.rfind("]")
+    if start == -1 or end < start:
+        raise ValueError("No JSON array in response")
+    items = json.loads(text[start:end + 1])
+    if not isinstance(items, list) or len(items) != count or not all(isinstance(item, dict) for item in items):
+        raise ValueError(f"Expected {count} objects, got {len(items) if isinstance(items, list) else type(items).__name__}")
+    # Trust the index field when it is a permutation of 0..count-1, else the array order
+    if sorted(str(item.get("index")) for item in items) == sorted(str(i) for i in range(count)):
+        items = sorted(items, key=lambda item: int(item["index"]))
+    return [
+        {field: str(item[field]).strip() if item.get(field) is not None else None for field in FIELDS}
+        for item in items
+    ]
+
+
+async def _extract_chunk(generate, email_texts):
+    response = await generate(build_batch_prompt(email_texts))
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        logger.info(f"Batch of {len(email_texts)}: {usage.prompt_token_count} prompt + "
+                    f"{usage.candidates_token_count} output tokens")
+    try:
+        return parse_batch_response(response.text, len(email_texts))
+    except ValueError as e:
+        if len(email_texts) == 1:
+            logger.warning(f"Could not parse extraction for a single email: {str(e)}")
+            return [None]
+        # Split and retry so one confusing email doesn't lose the whole batch
+        logger.warning(f"Could not parse batch of {len(email_texts)} ({str(e)}), splitting")
+        mid = len(email_texts) // 2
+        return await _extract_chunk(generate, email_texts[:mid]) + await _extract_chunk(generate, email_texts[mid:])
+
+
+async def extract_batch_async(email_texts, batch_size=EXTRACT_BATCH_SIZE, generate=generate_async):
+    """
+    Extract FIELDS from each email with one Gemini call per `batch_size` emails.
+    `generate` is an async prompt -> response callable, the LLM gateway by default.
+
+    Batches are sent concurrently (see async_io.map_bounded). Returns a list aligned
+    with `email_texts`; an entry is None when even a single-email prompt could not be
+    parsed or its batch timed out. Results are cached per email.
+    """
+    results = [None] * len(email_texts)
+    pending = []
+    for i, text in enumerate(email_texts):
+        cached = await run_blocking(llm_cache.get, BATCH_PROMPT_VERSION, text)
+        if cached is not None:
+            results[i] = json.loads(cached)
+        else:
+            pending.append(i)
+
+    batch_size = max(1, batch_size)
+    chunks = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+    extracted = await map_bounded(
+        lambda chunk: _extract_chunk(generate, [email_texts[i] for i in chunk]), chunks, reraise=(LLMUnavailableError,)
+    )
+    for chunk, chunk_results in zip(chunks, extracted):
+        for i, result in zip(chunk, chunk_results or [None] * len(chunk)):
+            results[i] = result
+            if result is not None:
+                await run_blocking(llm_cache.put, BATCH_PROMPT_VERSION, email_texts[i], json.dumps(result))
+    return results
@@ -0,0 +1,215 @@
+"""
+Benchmark per-message FETCH against batched UID FETCH.
+
+Runs a small local IMAP stand-in (plain TCP, no TLS) that adds a fixed delay to
+every command to simulate the round trip to Gmail, then times:
+
+  before  - SEARCH + one FETCH (RFC822) per message (the old router loop)
+  batched - UID SEARCH + whole messages in chunks of --batch-size
+  text    - UID SEARCH + BODYSTRUCTURE, then only the text/plain part (the default)
+
+Usage:
+    python benchmarks/imap_fetch_bench.py --messages 200 --latency-ms 20 --batch-size 50 --attachment-kb 512
+"""
+import argparse
+import base64
+import imaplib
+import os
+import re
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mail_fetch import uid_search, fetch_messages  # noqa: E402
+
+
+class StandInMessage:
+    """A synthetic request email, optionally with a base64 "scan" attached."""
+
+    def __init__(self, uid, body_size=2048, attachment_kb=0):
+        body = ("I am Student %d, roll no. %07d, requesting a certificate.\r\n" % (uid, 2200000 + uid)).encode()
+        self.body = body + b"x" * max(0, body_size - len(body))
+        self.headers = (
+            b"From: student%d@kiit.ac.in\r\n"
+            b"To: admin@kiit.ac.in\r\n"
+            b"Subject: [BONAFIDE] Request %d\r\n"
+            b"Date: Mon, 14 Jul 2025 10:00:00 +0530\r\n"
+            b"Message-ID: <%d@standin>\r\n" % (uid, uid, uid)
+        )
+        body_lines = self.body.count(b"\n") + 1
+        if not attachment_kb:
+            self.raw = self.headers + b"Content-Type: text/plain; charset=utf-8\r\n\r\n" + self.body
+            self.bodystructure = b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" %d %d)' % (len(self.body), body_lines)
+            return
+        scan = base64.encodebytes(os.urandom(attachment_kb * 1024))
+        self.raw = self.headers + (
+            b'MIME-Version: 1.0\r\nContent-Type: multipart/mixed; boundary="BOUND"\r\n\r\n'
+            b"--BOUND\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n" + self.body +
+            b'\r\n--BOUND\r\nContent-Type: application/pdf\r\nContent-Transfer-Encoding: base64\r\n'
+            b'Content-Disposition: attachment; filename="scan.pdf"\r\n\r\n' + scan +
+            b"\r\n--BOUND--\r\n"
+        )
+        self.bodystructure = (
+            b'(("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" %d %d NIL NIL)'
+            b' ("APPLICATION" "PDF" NIL NIL NIL "BASE64" %d NIL ("ATTACHMENT" ("FILENAME" "scan.pdf")))'
+            b' "MIXED" ("BOUNDARY" "BOUND"))' % (len(self.body), body_lines, len(scan))
+        )
+
+    def section(self, name):
+        if name in ("1", "1.1") or (name == "TEXT" and b"multipart" not in self.raw):
+            return self.body
+        return self.raw
+
+
+def expand_sequence_set(seq_set, highest):
+    numbers = []
+    for part in seq_set.split(","):
+        if ":" in part:
+            start, end = part.split(":")
+            start = highest if start == "*" else int(start)
+            end = highest if end == "*" else int(end)
+            numbers.extend(range(min(start, end), max(start, end) + 1))
+        else:
+            numbers.append(highest if part == "*" else int(part))
+    return [n for n in numbers if 1 <= n <= highest]
+
+
+class StandInIMAPHandler(socketserver.StreamRequestHandler):
+    """Understands just enough IMAP4rev1 for imaplib's login/select/search/fetch/logout."""
+
+    def send(self, data):
+        self.server.bytes_sent += len(data)
+        self.wfile.write(data)
+
+    def send_literal(self, name, data):
+        return b" %s {%d}\r\n" % (name, len(data)) + data
+
+    def fetch_response(self, number, message, items):
+        response = b"* %d FETCH (UID %d" % (number, number)
+        if "BODYSTRUCTURE" in items:
+            response += b" BODYSTRUCTURE " + message.bodystructure
+        fields = re.search(r"HEADER\.FIELDS \(([^)]*)\)", items)
+        if fields:
+            response += self.send_literal(b"BODY[HEADER.FIELDS (%s)]" % fields.group(1).encode(), message.headers + b"\r\n")
+        section = re.search(r"BODY(?:\.PEEK)?\[(\d[\d.]*)\]", items)
+        if section:
+            response += self.send_literal(b"BODY[%s]" % section.group(1).encode(), message.section(section.group(1)))
+        if "RFC822" in items or "BODY.PEEK[]" in items:
+            name = b"RFC822" if "RFC822" in items else b"BODY[]"
+            response += self.send_literal(name, message.raw)
+        return response + b")\r\n"
+
+    def handle(self):
+        messages = self.server.messages
+        self.send(b"* OK IMAP4rev1 stand-in ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, command = line.decode().rstrip("\r\n").partition(" ")
+            time.sleep(self.server.latency)
+            verb, _, args = command.partition(" ")
+            verb = verb.upper()
+            use_uid = verb == "UID"
+            if use_uid:
+                verb, _, args = args.partition(" ")
+                verb = verb.upper()
+
+            if verb == "CAPABILITY":
+                self.send(b"* CAPABILITY IMAP4rev1 IDLE UIDPLUS\r\n")
+            elif verb == "SELECT":
+                self.send(b"* %d EXISTS\r\n* OK [UIDVALIDITY 1] ok\r\n" % len(messages))
+            elif verb == "STATUS":
+                self.send(b"* STATUS inbox (UIDVALIDITY 1)\r\n")
+            elif verb == "SEARCH":
+                ids = " ".join(str(n) for n in range(1, len(messages) + 1))
+                self.send(("* SEARCH %s\r\n" % ids).encode())
+            elif verb == "FETCH":
+                seq_set, _, items = args.partition(" ")
+                for number in expand_sequence_set(seq_set, len(messages)):
+                    self.send(self.fetch_response(number, messages[number - 1], items))
+            elif verb == "STORE":
+                pass
+            elif verb == "LOGOUT":
+                self.send(b"* BYE logging out\r\n%s OK LOGOUT completed\r\n" % tag.encode())
+                return
+            self.send(b"%s OK %s completed\r\n" % (tag.encode(), verb.encode()))
+
+
+class StandInIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages, latency):
+        super().__init__(("127.0.0.1", 0), StandInIMAPHandler)
+        self.messages = messages
+        self.latency = latency
+        self.bytes_sent = 0
+
+
+def run_before(port):
+    imap_server = imaplib.IMAP4("127.0.0.1", port)
+    imap_server.login("admin", "secret")
+    imap_server.select("inbox")
+    status, messages = imap_server.search(None, '(SUBJECT "[BONAFIDE]")')
+    count = 0
+    for email_id in messages[0].split():
+        res, msg_data = imap_server.fetch(email_id, "(RFC822)")
+        if res == "OK" and msg_data[0][1]:
+            count += 1
+    imap_server.logout()
+    return count
+
+
+def run_after(port, batch_size, with_attachments):
+    imap_server = imaplib.IMAP4("127.0.0.1", port)
+    imap_server.login("admin", "secret")
+    imap_server.select("inbox")
+    email_ids = uid_search(imap_server, '(SUBJECT "[BONAFIDE]")')
+    count = 0
+    for _, msg in fetch_messages(imap_server, email_ids, batch_size=batch_size,
+                                    with_attachments=with_attachments, use_cache=False):
+        if msg.is_multipart() or b"roll no." in msg.get_payload(decode=True):
+            count += 1
+    imap_server.logout()
+    return count
+
+
+def timed(server, label, func, *args):
+    server.bytes_sent = 0
+    start = time.perf_counter()
+    count = func(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<8} {count:>6} messages  {elapsed:8.3f} s  {count / elapsed:10.1f} msg/s"
+          f"  {server.bytes_sent / 1024:10.1f} KiB")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--body-size", type=int, default=2048)
+    parser.add_argument("--attachment-kb", type=int, default=0)
+    args = parser.parse_args()
+
+    messages = [StandInMessage(uid, args.body_size, args.attachment_kb) for uid in range(1, args.messages + 1)]
+    server = StandInIMAPServer(messages, args.latency_ms / 1000.0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    print(f"{args.messages} messages, {args.latency_ms} ms per command, batch size {args.batch_size},"
+          f" {args.attachment_kb} KiB attachment")
+    before = timed(server, "before", run_before, port)
+    batched = timed(server, "batched", run_after, port, args.batch_size, True)
+    text = timed(server, "text", run_after, port, args.batch_size, False)
+    print(f"speedup  batched {before / batched:.1f}x, text {before / text:.1f}x")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark per-row rank updates against the set-based window-function UPDATE.
+
+Builds a throwaway students table with --students rows spread over --departments
+departments (CGPAs to two decimals, so there are plenty of ties), then times:
+
+  per-row  - SELECT ordered by CGPA + one UPDATE ... WHERE roll_no = ? per student (the old loop)
+  global   - ranking.update_ranks(), one UPDATE ... FROM (RANK() OVER ...) for everyone
+  dept     - the same, PARTITION BY department
+  unchanged - global again with nothing changed, which writes no rows
+
+Usage:
+    python benchmarks/rank_update_bench.py --students 100000 --departments 8
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ranking import update_ranks  # noqa: E402
+
+
+def build_db(path, students, departments):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute('''
+    CREATE TABLE students (
+        roll_no TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        cgpa REAL NOT NULL,
+        college_rank INTEGER NOT NULL,
+        department TEXT,
+        department_rank INTEGER
+    )
+    ''')
+    rng = random.Random(42)
+    conn.executemany(
+        "INSERT INTO students (roll_no, name, cgpa, college_rank, department) VALUES (?, ?, ?, 0, ?)",
+        [
+            (str(2200000 + i), f"Student {i}", round(rng.uniform(5, 10), 2), f"Dept {i % departments}")
+            for i in range(students)
+        ],
+    )
+    conn.commit()
+    return conn
+
+
+def per_row(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT roll_no, cgpa FROM students ORDER BY cgpa DESC, name ASC")
+    for rank, (roll_no, _) in enumerate(cursor.fetchall(), 1):
+        cursor.execute("UPDATE students SET college_rank = ? WHERE roll_no = ?", (rank, roll_no))
+    conn.commit()
+
+
+def timed_run(label, func):
+    start = time.perf_counter()
+    changed = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {elapsed * 1000:9.1f} ms" + (f"  {changed} rows changed" if changed is not None else ""))
+    return elapsed
+
+
+def set_based(conn, **kwargs):
+    changed = update_ranks(conn.cursor(), **kwargs)
+    conn.commit()
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=100000)
+    parser.add_argument("--departments", type=int, default=8)
+    args = parser.parse_args()
+
+    conn = build_db(os.path.join(tempfile.mkdtemp(), "students.db"), args.students, args.departments)
+    print(f"{args.students} students in {args.departments} departments")
+
+    before = timed_run("per-row", lambda: per_row(conn))
+    expected = conn.execute("SELECT roll_no, college_rank FROM students").fetchall()
+    conn.execute("UPDATE students SET college_rank = 0")
+    conn.commit()
+
+    # ROW_NUMBER reproduces the old loop exactly, which checks the set-based statement
+    set_based(conn, function="ROW_NUMBER")
+    assert conn.execute("SELECT roll_no, college_rank FROM students").fetchall() == expected, "rank mismatch"
+    conn.execute("UPDATE students SET college_rank = 0")
+    conn.commit()
+
+    after = timed_run("global", lambda: set_based(conn))
+    timed_run("dept", lambda: set_based(conn, column="department_rank", partition_by="department"))
+    timed_run("unchanged", lambda: set_based(conn))
+    print(f"speedup  {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
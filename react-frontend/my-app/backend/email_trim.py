@@ -0,0 +1,83 @@
+import logging
+import os
+import re
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+EMAIL_TOKEN_BUDGET = int(os.environ.get("EMAIL_TOKEN_BUDGET", "400"))   # max tokens of body text sent to the LLM
+CHARS_PER_TOKEN = 4   # rough Gemini/Groq average for English text
+
+# Everything after these lines is quoted history, a signature or a legal footer
+CUT_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+    r"^On .{0,200}wrote:\s*$",                                     # Gmail/Outlook reply header
+    r"^-{2,}\s*Original Message\s*-{2,}\s*$",
+    r"^-- ?$",                                                     # standard signature delimiter
+    r"^Sent from my \w+",
+    r"^(DISCLAIMER|CONFIDENTIALITY NOTICE)\b",
+    # Disclaimer wording only: "This email is intended to request ..." is an ordinary request
+    r"^This (e-?mail|message)( and any (files|attachments)[^.]*)? (is|are) "
+    r"((strictly )?(private and )?confidential\b|intended (only|solely|exclusively) for)",
+)]
+FORWARD_MARKER = re.compile(r"^-{2,}\s*Forwarded message\s*-{2,}\s*$", re.IGNORECASE)
+FORWARD_HEADER = re.compile(r"^(From|Sent|Date|To|Cc|Subject):", re.IGNORECASE)
+
+_stats_lock = threading.Lock()
+_stats = {"emails": 0, "tokens_in": 0, "tokens_out": 0}
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def trim_email_body(text, max_tokens=EMAIL_TOKEN_BUDGET):
+    """
+    Strip quoted replies, forwarded headers, signatures and footers from an email body
+    and cap what is left at `max_tokens`.
+    """
+    # "On Mon, 1 Jul 2025 at 10:00, Someone <a@b.c>" often wraps before "wrote:"
+    text = re.sub(r"^(On [^\n]{0,200})\n([^\n]{0,200}wrote:)", r"\1 \2", text or "", flags=re.MULTILINE)
+
+    lines = []
+    in_forward_headers = False
+    for line in text.splitlines():
+        stripped = line.strip()
+        if any(pattern.match(stripped) for pattern in CUT_PATTERNS):
+            break
+        if FORWARD_MARKER.match(stripped):
+            # Keep the forwarded request itself, but not its From/To/Subject block
+            in_forward_headers = True
+            continue
+        if in_forward_headers:
+            if FORWARD_HEADER.match(stripped):
+                continue
+            in_forward_headers = False
+        if stripped.startswith(">"):
+            continue
+        lines.append(line.rstrip())
+
+    trimmed = re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(trimmed) > max_chars:
+        cut = trimmed.rfind(" ", 0, max_chars)
+        trimmed = trimmed[:cut if cut > max_chars // 2 else max_chars]
+
+    before, after = estimate_tokens(text), estimate_tokens(trimmed)
+    with _stats_lock:
+        _stats["emails"] += 1
+        _stats["tokens_in"] += before
+        _stats["tokens_out"] += after
+    if before > after:
+        logger.debug(f"Trimmed email body from ~{before} to ~{after} tokens")
+    return trimmed
+
+
+def trim_stats():
+    """Estimated tokens before and after trimming, summed over all emails since startup."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["tokens_saved"] = stats["tokens_in"] - stats["tokens_out"]
+    return stats
@@ -0,0 +1,209 @@
+import logging
+import os
+import re
+import threading
+from abc import ABC, abstractmethod
+from dotenv import load_dotenv
+
+import llm_cache
+import student_db
+from async_io import run_blocking, map_bounded, run_coroutine
+from batch_extract import FIELDS, extract_batch_async
+from llm_gateway import generate, generate_async, LLMUnavailableError
+from fast_extract import ROLL_PATTERN, BARE_ROLL_PATTERN, NAME_PATTERN
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+EXTRACTOR_BACKEND = os.environ.get("EXTRACTOR_BACKEND", "gemini")       # "gemini" or "local"
+LOCAL_NER_MODEL   = os.environ.get("LOCAL_NER_MODEL", "en_core_web_sm")  # spaCy model, used if installed
+
+_MONTHS = r"(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec)[a-z]*\.?"
+_DATE = (
+    rf"(?:\d{{1,2}}[-/.]\d{{1,2}}[-/.]\d{{2,4}}"                  # 01-06-2025, 1/6/25
+    rf"|\d{{1,2}}(?:st|nd|rd|th)?\s+{_MONTHS},?\s+\d{{4}}"          # 1st June 2025
+    rf"|{_MONTHS}\s+\d{{1,2}}(?:st|nd|rd|th)?,?\s+\d{{4}})"         # June 1, 2025
+)
+PERIOD_PATTERN = re.compile(rf"(?:from\s+)?({_DATE})\s*(?:to|till|until|-)\s*({_DATE})", re.IGNORECASE)
+CGPA_PATTERN = re.compile(r"\bC?GPA\b\s*(?:is|of|:|-|=)?\s*(\d{1,2}(?:\.\d{1,2})?)", re.IGNORECASE)
+PRONOUN_HINTS = [
+    (re.compile(r"\b(Mr|Master)\b\.?|\bmy son\b", re.IGNORECASE), "his"),
+    (re.compile(r"\b(Ms|Mrs|Miss)\b\.?|\bmy daughter\b", re.IGNORECASE), "her"),
+]
+
+
+class Extractor(ABC):
+    """
+    Turns request email bodies into dicts keyed by batch_extract.FIELDS.
+
+    extract() returns one dict (or None if nothing could be extracted) per email,
+    in input order. Backends with uses_llm set may raise LLMUnavailableError.
+    """
+
+    name = None
+    uses_llm = False
+
+    @abstractmethod
+    def extract(self, email_texts):
+        """One dict (or None) per email in `email_texts`."""
+
+    async def extract_async(self, email_texts):
+        return await run_blocking(self.extract, email_texts)
+
+
+class ExtractionPrompt:
+    """
+    A router's own one-email Gemini prompt: `build(email_text)` returns the prompt, and
+    `parse(result_text)` a tuple of values for `fields` (None where nothing was found).
+    Results are cached in llm_cache under `version`; bump it when the prompt changes.
+    """
+
+    def __init__(self, version, build, parse, fields=("name", "roll_number")):
+        self.version = version
+        self.build = build
+        self.parse = parse
+        self.fields = fields
+
+    def to_fields(self, result_text):
+        fields = dict(zip(self.fields, self.parse(result_text)))
+        return fields if any(fields.values()) else None
+
+
+class GeminiExtractor(Extractor):
+    """
+    Gemini, either through the batched JSON-array prompt from batch_extract or, when given
+    a router's ExtractionPrompt, through that prompt one email at a time.
+    """
+
+    name = "gemini"
+    uses_llm = True
+
+    def __init__(self, prompt=None):
+        self.prompt = prompt
+
+    def extract(self, email_texts):
+        if self.prompt is None:
+            # Called from scan threads; the batch prompt itself is async
+            return run_coroutine(extract_batch_async(email_texts))
+        return [self._extract_one(email_text) for email_text in email_texts]
+
+    async def extract_async(self, email_texts):
+        if self.prompt is None:
+            return await extract_batch_async(email_texts)
+        return await map_bounded(self._extract_one_async, email_texts, reraise=(LLMUnavailableError,))
+
+    def _extract_one(self, email_text):
+        try:
+            result = llm_cache.get(self.prompt.version, email_text)
+            if result is None:
+                result = generate(self.prompt.build(email_text)).text
+                llm_cache.put(self.prompt.version, email_text, result)
+        except LLMUnavailableError:
+            # Quota or outage: the caller retries later instead of answering that nothing was found
+            raise
+        except Exception as e:
+            logger.error(f"Error in AI extraction: {str(e)}")
+            return None
+        logger.info(f"AI extraction result: {result}")
+        return self.prompt.to_fields(result)
+
+    async def _extract_one_async(self, email_text):
+        result = await run_blocking(llm_cache.get, self.prompt.version, email_text)
+        if result is None:
+            result = (await generate_async(self.prompt.build(email_text))).text
+            await run_blocking(llm_cache.put, self.prompt.version, email_text, result)
+        return self.prompt.to_fields(result)
+
+
+class LocalExtractor(Extractor):
+    """
+    Offline rules plus optional spaCy NER, all on the CPU.
+
+    Names and dates come from the same introduction/roll patterns as the fast path and
+    from date ranges in the text; spaCy PERSON/DATE entities fill the gaps when a model
+    is installed. Known roll numbers are completed with the name and CGPA in students.db.
+    """
+
+    name = "local"
+
+    def __init__(self):
+        self._nlp = None
+        self._nlp_loaded = False
+        self._lock = threading.Lock()
+
+    def _load_nlp(self):
+        # Loaded once, on first use; rules alone still work without spaCy
+        with self._lock:
+            if not self._nlp_loaded:
+                self._nlp_loaded = True
+                try:
+                    import spacy
+                    self._nlp = spacy.load(LOCAL_NER_MODEL, disable=["parser", "lemmatizer"])
+                    logger.info(f"Loaded NER model {LOCAL_NER_MODEL}")
+                except (ImportError, OSError) as e:
+                    logger.info(f"NER model unavailable ({str(e)}), using rules only")
+            return self._nlp
+
+    def _lookup(self, rollnums):
+        return {
+            roll_no: (student["name"], student["cgpa"])
+            for roll_no, student in student_db.get_students(rollnums).items()
+        }
+
+    def extract(self, email_texts):
+        candidates = []
+        for text in email_texts:
+            rolls = [re.sub(r'[.,]$', '', match.group(1)) for match in ROLL_PATTERN.finditer(text)]
+            rolls += BARE_ROLL_PATTERN.findall(text)
+            candidates.append(list(dict.fromkeys(r for r in rolls if any(ch.isdigit() for ch in r))))
+        known = self._lookup({roll for rolls in candidates for roll in rolls})
+
+        nlp = self._load_nlp()
+        docs = nlp.pipe(email_texts, batch_size=32) if nlp is not None else [None] * len(email_texts)
+
+        results = []
+        for text, rolls, doc in zip(email_texts, candidates, docs):
+            entities = [(ent.label_, ent.text.strip()) for ent in doc.ents] if doc is not None else []
+            # Prefer the roll number that is actually in the database
+            roll = next((r for r in rolls if r in known), rolls[0] if rolls else None)
+            db_name, db_cgpa = known.get(roll, (None, None))
+
+            name_match = NAME_PATTERN.search(text)
+            name = ' '.join(name_match.group(1).split()) if name_match else None
+            name = name or next((value for label, value in entities if label == "PERSON"), None) or db_name
+
+            period = PERIOD_PATTERN.search(text)
+            dates = [value for label, value in entities if label == "DATE"]
+            from_date, to_date = period.groups() if period else (dates + [None, None])[:2]
+
+            cgpa_match = CGPA_PATTERN.search(text)
+            cgpa = cgpa_match.group(1) if cgpa_match else (str(db_cgpa) if db_cgpa is not None else None)
+
+            pronoun = next((value for pattern, value in PRONOUN_HINTS if pattern.search(text)), None)
+
+            fields = dict(zip(FIELDS, (name, roll, from_date, to_date, pronoun, cgpa)))
+            results.append(fields if name or roll else None)
+        return results
+
+
+_extractors = {}
+_extractors_lock = threading.Lock()
+
+
+def get_extractor(name=None, prompt=None):
+    """
+    Return the shared extractor for `name`, or for EXTRACTOR_BACKEND when not given.
+
+    `prompt` (an ExtractionPrompt) is the router's own Gemini prompt; the local backend
+    needs none and ignores it.
+    """
+    name = (name or EXTRACTOR_BACKEND).lower()
+    backends = {"gemini": GeminiExtractor, "local": LocalExtractor}
+    if name not in backends:
+        raise ValueError(f"Unknown extractor backend {name!r}, expected one of {', '.join(backends)}")
+    key = (name, prompt.version) if prompt is not None and name == "gemini" else (name, None)
+    with _extractors_lock:
+        if key not in _extractors:
+            _extractors[key] = GeminiExtractor(prompt) if key[1] is not None else backends[name]()
+        return _extractors[key]
@@ -0,0 +1,103 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+from dotenv import load_dotenv
+
+import student_db
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+FAST_EXTRACT_MIN_CONFIDENCE = float(os.environ.get("FAST_EXTRACT_MIN_CONFIDENCE", "0.8"))   # below this, ask the LLM
+
+# Same fallback patterns as main_backend.parse_extraction_result, plus bare 7-digit roll numbers
+ROLL_PATTERN = re.compile(r"roll(?:\s+(?:no|number|#))?\.*\s*:?\s*([A-Za-z0-9]+)", re.IGNORECASE)
+BARE_ROLL_PATTERN = re.compile(r"\b(\d{7})\b")
+# The name must follow an introduction; without one the fallback pattern also matches greetings
+NAME_PATTERN = re.compile(r"(?:I am|This is|My name is)\s+([A-Za-z\s]+?)(?:\s*,|\s+roll|\s+and\b|\s*\.)", re.IGNORECASE)
+
+_stats_lock = threading.Lock()
+_stats = {"fast_path": 0, "llm": 0}
+
+
+def names_likely_match(name1, name2):
+    """
+    Check if two names likely refer to the same person, e.g. "Bhaskar Lalwani" / "Bhaskar".
+    Shared by the fast path and the rank and scholarship routers; an empty name never matches.
+    """
+    n1 = ' '.join((name1 or "").lower().split())
+    n2 = ' '.join((name2 or "").lower().split())
+    if not n1 or not n2:
+        return False
+    if n1 in n2 or n2 in n1:
+        return True
+    words1 = set(n1.split())
+    words2 = set(n2.split())
+    common_words = words1.intersection(words2)
+    return len(common_words) >= 2 or (len(common_words) == 1 and len(words1) == 1 and len(words2) == 1)
+
+
+def lookup_names(rollnums):
+    """Return {roll_no: name} for the roll numbers present in the students table."""
+    return {roll_no: student["name"] for roll_no, student in student_db.get_students(rollnums).items()}
+
+
+def extract_name_and_roll(email_text):
+    """
+    Deterministically extract (name, roll number, confidence) from a request email.
+
+    Confidence is 1.0 when exactly one roll number in the text exists in students.db and
+    the introduced name matches that student, 0.9 when no name was introduced but the
+    student's name still appears in the text, and low otherwise.
+    """
+    candidates = []
+    for match in ROLL_PATTERN.finditer(email_text):
+        candidates.append(re.sub(r'[.,]$', '', match.group(1)))
+    candidates.extend(BARE_ROLL_PATTERN.findall(email_text))
+    candidates = list(dict.fromkeys(c for c in candidates if any(ch.isdigit() for ch in c)))
+
+    name_match = NAME_PATTERN.search(email_text)
+    name = ' '.join(name_match.group(1).split()) if name_match else None
+
+    known = lookup_names(candidates)
+    if len(known) != 1:
+        # No roll number we recognise, or several: let the LLM decide
+        return name, candidates[0] if candidates else None, 0.3 if known else 0.2
+
+    rollnum, db_name = next(iter(known.items()))
+    if name:
+        return name, rollnum, 1.0 if names_likely_match(name, db_name) else 0.4
+    text_words = set(re.findall(r"[a-z]+", email_text.lower()))
+    first_name = (db_name or "").lower().split()[:1]
+    if first_name and first_name[0] in text_words:
+        return db_name, rollnum, 0.9
+    return None, rollnum, 0.6
+
+
+def try_fast_path(email_text):
+    """Return (name, roll number) if the rule-based extractor is confident enough, else None."""
+    try:
+        name, rollnum, confidence = extract_name_and_roll(email_text)
+    except sqlite3.Error as e:
+        logger.error(f"Fast-path lookup failed: {str(e)}")
+        confidence = 0.0
+    hit = confidence >= FAST_EXTRACT_MIN_CONFIDENCE
+    with _stats_lock:
+        _stats["fast_path" if hit else "llm"] += 1
+    if hit:
+        logger.info(f"Fast-path extraction: {name}, {rollnum} (confidence {confidence:.1f})")
+        return name, rollnum
+    logger.info(f"Fast-path confidence {confidence:.1f} too low, falling back to the LLM")
+    return None
+
+
+def fast_path_stats():
+    """Counts of requests answered by the rules vs. sent to the LLM, and the fast-path hit rate."""
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats["fast_path"] + stats["llm"]
+    stats["hit_rate"] = stats["fast_path"] / total if total else 0.0
+    return stats
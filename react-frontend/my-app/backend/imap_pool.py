@@ -0,0 +1,168 @@
+import imaplib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+IMAP_SERVER         = "imap.gmail.com"
+IMAP_POOL_SIZE      = int(os.environ.get("IMAP_POOL_SIZE", "2"))         # max concurrent sessions per account
+IMAP_NOOP_INTERVAL  = int(os.environ.get("IMAP_NOOP_INTERVAL", "60"))    # seconds before an idle session is re-checked
+IMAP_MAX_IDLE       = int(os.environ.get("IMAP_MAX_IDLE", "1500"))       # seconds before an idle session is dropped
+
+# Errors that mean the session is unusable and must be replaced
+STALE_ERRORS = (imaplib.IMAP4.abort, OSError, EOFError)
+
+
+class IMAPSessionPool:
+    """Keeps a small set of logged-in IMAP sessions that callers borrow and return."""
+
+    def __init__(self, host, username, password,
+                 max_sessions=IMAP_POOL_SIZE, noop_interval=IMAP_NOOP_INTERVAL, max_idle=IMAP_MAX_IDLE):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.noop_interval = noop_interval
+        self.max_idle = max_idle
+        self._slots = threading.BoundedSemaphore(max_sessions)
+        self._lock = threading.Lock()
+        self._idle = []         # [(conn, last_used)] ready to be borrowed
+        self._mailbox = {}      # id(conn) -> currently selected mailbox
+        self._keepalive = None
+        self._closed = False
+
+    def _connect(self):
+        conn = imaplib.IMAP4_SSL(self.host)
+        conn.login(self.username, self.password)
+        logger.info(f"Opened IMAP session for {self.username}")
+        return conn
+
+    def _drop(self, conn):
+        self._mailbox.pop(id(conn), None)
+        try:
+            conn.logout()
+        except Exception:
+            pass
+
+    def _is_alive(self, conn, last_used):
+        """Send NOOP when the session has been idle long enough that the server may have dropped it."""
+        idle_for = time.monotonic() - last_used
+        if idle_for > self.max_idle:
+            return False
+        if idle_for < self.noop_interval:
+            return True
+        try:
+            status, _ = conn.noop()
+            return status == "OK"
+        except STALE_ERRORS + (imaplib.IMAP4.error,):
+            return False
+
+    def _checkout(self, mailbox):
+        conn = None
+        while conn is None:
+            with self._lock:
+                candidate = self._idle.pop() if self._idle else None
+            if candidate is None:
+                conn = self._connect()
+            elif self._is_alive(*candidate):
+                conn = candidate[0]
+            else:
+                logger.info("Discarding stale IMAP session")
+                self._drop(candidate[0])
+
+        if mailbox and self._mailbox.get(id(conn)) != mailbox:
+            conn.select(mailbox)
+            self._mailbox[id(conn)] = mailbox
+        return conn
+
+    def _checkin(self, conn):
+        with self._lock:
+            if self._closed:
+                self._drop(conn)
+                return
+            self._idle.append((conn, time.monotonic()))
+        self._start_keepalive()
+
+    @contextmanager
+    def session(self, mailbox="inbox"):
+        """Borrow a logged-in session with `mailbox` selected; blocks while the pool is at capacity."""
+        self._slots.acquire()
+        conn = None
+        try:
+            conn = self._checkout(mailbox)
+            yield conn
+        except STALE_ERRORS:
+            # Never hand a broken connection back to the next caller
+            if conn is not None:
+                self._drop(conn)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._checkin(conn)
+            self._slots.release()
+
+    def _start_keepalive(self):
+        if self._keepalive is not None and self._keepalive.is_alive():
+            return
+        self._keepalive = threading.Thread(target=self._keepalive_loop, name="imap-keepalive", daemon=True)
+        self._keepalive.start()
+
+    def _keepalive_loop(self):
+        while not self._closed:
+            time.sleep(self.noop_interval)
+            with self._lock:
+                idle, self._idle = self._idle, []
+            survivors = []
+            for conn, last_used in idle:
+                if self._is_alive(conn, last_used):
+                    survivors.append((conn, last_used))
+                else:
+                    self._drop(conn)
+            with self._lock:
+                self._idle.extend(survivors)
+                if not self._idle:
+                    break
+
+    def close(self):
+        """Log out every idle session; sessions still borrowed are logged out on return."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._drop(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(username=None, password=None, host=IMAP_SERVER):
+    """Return the shared pool for an account, creating it on first use."""
+    username = username or os.environ.get("EMAIL")
+    password = password or os.environ.get("EMAIL_PASSWORD")
+    key = (host, username)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool._closed:
+            pool = IMAPSessionPool(host, username, password)
+            _pools[key] = pool
+        return pool
+
+
+def imap_session(username=None, password=None, mailbox="inbox"):
+    """Shortcut for `get_pool(...).session(mailbox)`, used by all certificate routers."""
+    return get_pool(username, password).session(mailbox)
+
+
+def close_all_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,76 @@
+import hashlib
+import logging
+import os
+import time
+from dotenv import load_dotenv
+
+from sqlite_cache import SQLiteCache
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_PATH      = os.environ.get("LLM_CACHE_PATH", "llm_cache.db")
+LLM_CACHE_TTL       = int(os.environ.get("LLM_CACHE_TTL", str(30 * 24 * 3600)))          # seconds an extraction stays valid
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))  # evict beyond this size
+
+def _create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS extractions (
+        key TEXT PRIMARY KEY,
+        prompt_version TEXT NOT NULL,
+        result TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created REAL NOT NULL,
+        last_access REAL NOT NULL
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_extractions_last_access ON extractions (last_access)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_extractions_created ON extractions (created)")
+
+
+_cache = SQLiteCache(LLM_CACHE_PATH, "extractions", _create_tables, LLM_CACHE_MAX_BYTES, "extractions")
+
+
+def normalize_body(email_text):
+    """Collapse whitespace so re-wrapped or re-encoded copies of the same email share a key."""
+    return ' '.join((email_text or "").split())
+
+
+def cache_key(prompt_version, email_text):
+    return hashlib.sha256(f"{prompt_version}\0{normalize_body(email_text)}".encode("utf-8")).hexdigest()
+
+
+def get(prompt_version, email_text):
+    """Return the cached LLM output for this email and prompt version, or None if missing or expired."""
+    key = cache_key(prompt_version, email_text)
+    now = time.time()
+    conn = _cache.connect()
+    row = conn.execute("SELECT result, created FROM extractions WHERE key = ?", (key,)).fetchone()
+    if row and now - row[1] > LLM_CACHE_TTL:
+        conn.execute("DELETE FROM extractions WHERE key = ?", (key,))
+        row = None
+    elif row:
+        conn.execute("UPDATE extractions SET last_access = ? WHERE key = ?", (now, key))
+    conn.commit()
+    conn.close()
+    return row[0] if row else None
+
+
+def put(prompt_version, email_text, result):
+    """Store the LLM output for this email and evict the least recently used entries if over budget."""
+    now = time.time()
+    conn = _cache.connect()
+    conn.execute('''
+    INSERT OR REPLACE INTO extractions (key, prompt_version, result, size, created, last_access)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ''', (cache_key(prompt_version, email_text), prompt_version, result, len(result.encode("utf-8")), now, now))
+    conn.commit()
+    _evict(conn)
+    conn.close()
+
+
+def _evict(conn):
+    conn.execute("DELETE FROM extractions WHERE created < ?", (time.time() - LLM_CACHE_TTL,))
+    conn.commit()
+    _cache.evict(conn)
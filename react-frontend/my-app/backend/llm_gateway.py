@@ -0,0 +1,337 @@
+import logging
+import os
+import random
+import threading
+import time
+from dotenv import load_dotenv
+
+import metrics
+from async_io import run_blocking
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+LLM_MAX_RETRIES       = int(os.environ.get("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE      = float(os.environ.get("LLM_BACKOFF_BASE", "1.0"))      # seconds, doubled per attempt
+LLM_BACKOFF_MAX       = float(os.environ.get("LLM_BACKOFF_MAX", "30"))
+LLM_MAX_IN_FLIGHT     = int(os.environ.get("LLM_MAX_IN_FLIGHT", "8"))         # concurrent calls per provider
+LLM_QUEUE_LIMIT       = int(os.environ.get("LLM_QUEUE_LIMIT", "200"))         # callers allowed to wait per provider
+LLM_QUEUE_TIMEOUT     = float(os.environ.get("LLM_QUEUE_TIMEOUT", "120"))     # max wait for a slot and quota
+LLM_BREAKER_THRESHOLD = int(os.environ.get("LLM_BREAKER_THRESHOLD", "5"))     # failed calls in a row before opening
+LLM_BREAKER_RESET     = float(os.environ.get("LLM_BREAKER_RESET", "60"))      # seconds before a trial call
+
+# Per-minute quotas; the defaults are the free-tier limits of the models we use
+QUOTAS = {
+    "gemini": {
+        "rpm": int(os.environ.get("GEMINI_RPM", "15")),
+        "tpm": int(os.environ.get("GEMINI_TPM", "1000000")),
+        "model": os.environ.get("GEMINI_MODEL", "gemini-1.5-flash"),
+    },
+    "groq": {
+        "rpm": int(os.environ.get("GROQ_RPM", "30")),
+        "tpm": int(os.environ.get("GROQ_TPM", "6000")),
+        "model": os.environ.get("GROQ_MODEL", "llama-3.3-70b-versatile"),
+    },
+}
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+CHARS_PER_TOKEN = 4
+DEFAULT_OUTPUT_TOKENS = 256   # reserved from the token bucket when the caller gives no max_tokens
+
+
+class LLMGatewayError(Exception):
+    """Base class for errors raised by the gateway itself."""
+
+
+class LLMUnavailableError(LLMGatewayError):
+    """The provider can't take the call right now (quota, open circuit, full queue); try again later."""
+
+
+class Usage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class LLMResponse:
+    """Provider-independent response with the attributes callers already use on Gemini responses."""
+
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class ProviderHTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.code = status
+
+
+class TokenBucket:
+    """Refills `rate_per_minute` units per minute up to one minute's worth; take() waits for enough units."""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount, timeout):
+        amount = min(float(amount), self.capacity)
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return True
+                wait = (amount - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(min(wait, 1.0))
+
+
+class CircuitBreaker:
+    """Opens after `threshold` failed calls in a row, then lets one trial call through every `reset_after` seconds."""
+
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def blocked(self):
+        """True while open and not yet due a trial; checks without claiming the trial."""
+        with self.lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_after
+
+    def allow(self):
+        """Let a call through; when half-open, the first caller claims the trial. Call right before the call itself."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_after:
+                # Half-open: this caller is the trial, everyone else waits another period
+                self.opened_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Circuit opened after {self.failures} failed LLM calls")
+                self.opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        with self.lock:
+            return "closed" if self.opened_at is None else "open"
+
+
+class GeminiProvider:
+    name = "gemini"
+
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _model(self, model_name):
+        # Imported here so Groq-only scripts don't need the Gemini SDK
+        import google.generativeai as genai
+        with self._lock:
+            if not self._models:
+                genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
+            if model_name not in self._models:
+                self._models[model_name] = genai.GenerativeModel(model_name)
+            return self._models[model_name]
+
+    def call(self, prompt, model, max_tokens=None, **options):
+        # generate() takes the OpenAI-style max_tokens for every provider; Gemini calls it max_output_tokens
+        if max_tokens is not None:
+            options["generation_config"] = {**(options.get("generation_config") or {}), "max_output_tokens": int(max_tokens)}
+        response = self._model(model).generate_content(prompt, **options)
+        usage = getattr(response, "usage_metadata", None)
+        return LLMResponse(
+            response.text,
+            Usage(usage.prompt_token_count, usage.candidates_token_count) if usage is not None else None,
+        )
+
+
+class GroqProvider:
+    name = "groq"
+    url = "https://api.groq.com/openai/v1/chat/completions"
+
+    def __init__(self):
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _client(self):
+        with self._lock:
+            if self._session is None:
+                import requests
+                self._session = requests.Session()
+                self._session.headers.update({
+                    "Authorization": f"Bearer {os.environ.get('GROQ_API_KEY')}",
+                    "Content-Type": "application/json",
+                })
+            return self._session
+
+    def call(self, prompt, model, system=None, **options):
+        messages = ([{"role": "system", "content": system}] if system else []) + [{"role": "user", "content": prompt}]
+        response = self._client().post(self.url, json={"model": model, "messages": messages, **options}, timeout=60)
+        if response.status_code != 200:
+            raise ProviderHTTPError(response.status_code, response.text)
+        body = response.json()
+        usage = body.get("usage") or {}
+        return LLMResponse(
+            body.get("choices", [{}])[0].get("message", {}).get("content", ""),
+            Usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)) if usage else None,
+        )
+
+
+def _is_retryable(error):
+    status = getattr(error, "code", None)
+    if isinstance(status, int) and status in RETRYABLE_STATUS:
+        return True
+    # google.api_core and requests connection/timeout errors carry no HTTP status
+    return type(error).__name__ in (
+        "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+        "DeadlineExceeded", "ConnectionError", "Timeout", "ReadTimeout", "ConnectTimeout",
+    ) or isinstance(error, (ConnectionError, TimeoutError))
+
+
+class _ProviderState:
+    def __init__(self, provider, quota):
+        self.provider = provider
+        self.default_model = quota["model"]
+        self.requests = TokenBucket(quota["rpm"])
+        self.tokens = TokenBucket(quota["tpm"])
+        self.breaker = CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_RESET)
+        self.slots = threading.BoundedSemaphore(LLM_MAX_IN_FLIGHT)
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.stats = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0, "prompt_tokens": 0, "output_tokens": 0}
+
+
+class LLMGateway:
+    """
+    Shared entry point for every LLM call.
+
+    Each provider gets one reused client, token buckets sized to its per-minute request
+    and token quota, a bounded queue of waiting callers, jittered exponential-backoff
+    retries for 429/5xx/connection errors, and a circuit breaker that fails fast while
+    the provider keeps erroring.
+    """
+
+    def __init__(self, providers):
+        self._states = {provider.name: _ProviderState(provider, QUOTAS[provider.name]) for provider in providers}
+
+    def generate(self, prompt, provider="gemini", model=None, **options):
+        """Call `provider` with `prompt`, waiting for quota and retrying transient errors."""
+        state = self._states[provider]
+        # Fail fast while open; the half-open trial is only claimed once quota is in hand, so a
+        # trial refused for quota can't keep the circuit open for another period
+        if state.breaker.blocked():
+            self._reject(state, f"{provider} circuit is open")
+
+        with state.lock:
+            if state.waiting >= LLM_QUEUE_LIMIT:
+                state.stats["rejected"] += 1
+                raise LLMUnavailableError(f"{provider} queue is full ({state.waiting} waiting)")
+            state.waiting += 1
+        try:
+            deadline = time.monotonic() + LLM_QUEUE_TIMEOUT
+            if not state.slots.acquire(timeout=LLM_QUEUE_TIMEOUT):
+                self._reject(state, f"Timed out waiting for a {provider} slot")
+        finally:
+            with state.lock:
+                state.waiting -= 1
+
+        try:
+            estimate = len(prompt) // CHARS_PER_TOKEN + int(options.get("max_tokens", DEFAULT_OUTPUT_TOKENS))
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                remaining = max(0.0, deadline - time.monotonic())
+                if not (state.requests.take(1, remaining) and state.tokens.take(estimate, remaining)):
+                    self._reject(state, f"{provider} quota exhausted for the next {LLM_QUEUE_TIMEOUT:.0f}s")
+                if attempt == 0 and not state.breaker.allow():
+                    self._reject(state, f"{provider} circuit is open")
+                try:
+                    response = state.provider.call(prompt, model or state.default_model, **options)
+                except Exception as e:
+                    if not _is_retryable(e) or attempt == LLM_MAX_RETRIES:
+                        with state.lock:
+                            state.stats["failures"] += 1
+                        if not _is_retryable(e):
+                            # A bad request says nothing about the provider's health
+                            raise
+                        state.breaker.record_failure()
+                        raise LLMUnavailableError(f"{provider} failed after {attempt + 1} attempts: {str(e)}") from e
+                    # Full jitter so a burst of 429s doesn't retry in lockstep
+                    delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+                    logger.warning(f"{provider} call failed ({str(e)}), retrying in {delay:.1f}s")
+                    with state.lock:
+                        state.stats["retries"] += 1
+                    deadline = max(deadline, time.monotonic() + delay + LLM_QUEUE_TIMEOUT)
+                    time.sleep(delay)
+                    continue
+                state.breaker.record_success()
+                with state.lock:
+                    state.stats["calls"] += 1
+                    if response.usage_metadata is not None:
+                        state.stats["prompt_tokens"] += response.usage_metadata.prompt_token_count
+                        state.stats["output_tokens"] += response.usage_metadata.candidates_token_count
+                usage = response.usage_metadata
+                metrics.record_tokens(usage.prompt_token_count if usage else 0, usage.candidates_token_count if usage else 0)
+                return response
+        finally:
+            state.slots.release()
+
+    def _reject(self, state, message):
+        with state.lock:
+            state.stats["rejected"] += 1
+        raise LLMUnavailableError(message)
+
+    def stats(self):
+        result = {}
+        for name, state in self._states.items():
+            with state.lock:
+                result[name] = dict(state.stats, waiting=state.waiting, circuit=state.breaker.state)
+        return result
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway([GeminiProvider(), GroqProvider()])
+        return _gateway
+
+
+def generate(prompt, provider="gemini", model=None, **options):
+    return get_gateway().generate(prompt, provider, model, **options)
+
+
+async def generate_async(prompt, provider="gemini", model=None, **options):
+    """generate() on the I/O thread pool, so quota waits and backoff never block the event loop."""
+    return await run_blocking(get_gateway().generate, prompt, provider, model, **options)
+
+
+def gateway_stats():
+    return get_gateway().stats()
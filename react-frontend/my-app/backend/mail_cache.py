@@ -0,0 +1,113 @@
+import logging
+import os
+import time
+from dotenv import load_dotenv
+
+from sqlite_cache import SQLiteCache
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MAIL_CACHE_PATH      = os.environ.get("MAIL_CACHE_PATH", "mail_cache.db")
+MAIL_CACHE_MAX_BYTES = int(os.environ.get("MAIL_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))   # evict beyond this size
+
+def _create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS raw_messages (
+        mailbox TEXT NOT NULL,
+        uidvalidity INTEGER NOT NULL,
+        uid INTEGER NOT NULL,
+        message_id TEXT,
+        complete INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        last_access REAL NOT NULL,
+        PRIMARY KEY (mailbox, uidvalidity, uid)
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_raw_messages_message_id ON raw_messages (message_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_raw_messages_last_access ON raw_messages (last_access)")
+
+
+_cache = SQLiteCache(MAIL_CACHE_PATH, "raw_messages", _create_tables, MAIL_CACHE_MAX_BYTES, "messages")
+
+
+def get_many(uids, uidvalidity, mailbox="inbox", complete=False):
+    """
+    Return {uid: raw bytes} for the cached UIDs.
+
+    With complete=True only whole messages qualify; otherwise the text-only copies
+    stored by the default fetch path are returned as well.
+    """
+    if not uids:
+        return {}
+    found = {}
+    conn = _cache.connect()
+    numbers = [int(uid) for uid in uids]
+    # Stay well below SQLite's bound parameter limit
+    for start in range(0, len(numbers), 500):
+        chunk = numbers[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(
+            f"SELECT uid, data FROM raw_messages WHERE mailbox = ? AND uidvalidity = ? AND complete >= ? "
+            f"AND uid IN ({placeholders})",
+            [mailbox, uidvalidity, int(complete)] + chunk,
+        ).fetchall()
+        found.update({str(uid).encode(): data for uid, data in rows})
+        if rows:
+            conn.execute(
+                f"UPDATE raw_messages SET last_access = ? WHERE mailbox = ? AND uidvalidity = ? "
+                f"AND uid IN ({','.join('?' * len(rows))})",
+                [time.time(), mailbox, uidvalidity] + [uid for uid, _ in rows],
+            )
+    conn.commit()
+    conn.close()
+    return found
+
+
+def put_many(messages, uidvalidity, mailbox="inbox", complete=False):
+    """Store [(uid, message_id, raw bytes)] and evict the least recently used entries if over budget."""
+    if not messages:
+        return
+    now = time.time()
+    conn = _cache.connect()
+    conn.executemany('''
+    INSERT INTO raw_messages (mailbox, uidvalidity, uid, message_id, complete, size, data, last_access)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (mailbox, uidvalidity, uid) DO UPDATE SET
+        complete = MAX(complete, excluded.complete),
+        message_id = excluded.message_id,
+        size = CASE WHEN excluded.complete >= complete THEN excluded.size ELSE size END,
+        data = CASE WHEN excluded.complete >= complete THEN excluded.data ELSE data END,
+        last_access = excluded.last_access
+    ''', [
+        (mailbox, uidvalidity, int(uid), message_id, int(complete), len(raw), raw, now)
+        for uid, message_id, raw in messages
+    ])
+    conn.commit()
+    _cache.evict(conn)
+    conn.close()
+
+
+def get_by_message_ids(message_ids):
+    """
+    Return {message_id: raw bytes} for the Message-IDs already cached under any mailbox,
+    UIDVALIDITY or UID, preferring the most complete, most recently used copy.
+    """
+    message_ids = [message_id for message_id in dict.fromkeys(message_ids) if message_id]
+    if not message_ids:
+        return {}
+    found = {}
+    conn = _cache.connect()
+    for start in range(0, len(message_ids), 500):
+        chunk = message_ids[start:start + 500]
+        # Ascending, so the preferred copy of each Message-ID is the one left in `found`
+        for message_id, data in conn.execute(
+            f"SELECT message_id, data FROM raw_messages WHERE message_id IN ({','.join('?' * len(chunk))}) "
+            f"ORDER BY complete, last_access",
+            chunk,
+        ):
+            found[message_id] = data
+    conn.close()
+    return found
@@ -0,0 +1,195 @@
+import logging
+import os
+import threading
+from contextlib import ExitStack
+from email.header import decode_header, make_header
+
+from imap_pool import imap_session
+from mail_fetch import uid_search, fetch_messages
+from mail_sync import get_uidvalidity, current_watermark, advance_watermark
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+HANDLER_MAX_ATTEMPTS = int(os.environ.get("HANDLER_MAX_ATTEMPTS", "3"))   # scans that retry a failing message before it is skipped
+
+# Request tag -> text that marks it in a subject line. WIFI RESET mail is left to the
+# Gmail API agent in -compliance-agents/test1.py, which answers it on its own
+REQUEST_TAGS = {
+    "BONAFIDE": "[BONAFIDE]",
+    "NOC": "[NOC]",
+    "RANK": "[RANK]",
+    "SCHOLARSHIP": "[SCHOLARSHIP]",
+}
+
+# tag -> (handle, prepare, finish, unseen_only)
+_handlers = {}
+
+# tag -> lock held for the whole scan of that tag. The listener, the process endpoints and
+# the admin page refreshes can all start a scan; the watermark only moves after a message
+# is handled, so two overlapping scans would handle (and answer) the same request twice
+_scan_locks = {}
+_scan_locks_guard = threading.Lock()
+
+# (tag, uid) -> failed attempts so far, for messages whose handler raised something other
+# than RetryLater (a locked database, an SMTP error, ...). Only touched under the tag's scan lock
+_failures = {}
+
+
+class RetryLater(Exception):
+    """Raised by a handler that can't process a message yet (e.g. the LLM is over quota)."""
+
+
+def register_message_handler(tag, handle, prepare=None, finish=None, unseen_only=False):
+    """
+    Route messages for a request tag to a pipeline.
+
+    handle(imap_server, email_id, msg, username, password) is called once per new message,
+    and prepare() once per scan before the first message for that tag. finish() runs after
+    every scan of the tag, once the IMAP session is released, so batch work (e.g. extracting
+    everything handle() stored) never holds a connection; it may raise RetryLater too.
+    With unseen_only=True, messages already flagged \\Seen are skipped (and their
+    watermark moved past) without calling handle().
+    """
+    _handlers[tag.upper()] = (handle, prepare, finish, unseen_only)
+
+
+def registered_tags():
+    return list(_handlers)
+
+
+def classify_subject(subject):
+    """Return the request tags present in a subject line, e.g. "[RANK] request" -> {"RANK"}."""
+    try:
+        subject = str(make_header(decode_header(subject or "")))
+    except Exception:
+        subject = subject or ""
+    subject = subject.upper()
+    return {tag for tag, needle in REQUEST_TAGS.items() if needle in subject}
+
+
+def build_search_criteria(tags, last_uid=0):
+    """One UID SEARCH for all tags, e.g. 'UID 5:* OR SUBJECT "[NOC]" SUBJECT "[RANK]"'."""
+    subjects = [f'SUBJECT "{REQUEST_TAGS[tag]}"' for tag in tags]
+    criteria = " ".join(["OR"] * (len(subjects) - 1) + subjects)
+    return f"UID {last_uid + 1}:* {criteria}"
+
+
+def scan_inbox(tags=None, username=None, password=None, deferred=None, run_finish=True):
+    """
+    Single ingestion pass over the inbox for every registered pipeline (or just `tags`).
+
+    Runs one OR'ed UID SEARCH above the lowest per-tag watermark, fetches the matches
+    once in batches, and hands each message to the handler for each tag in its subject.
+    When a handler raises RetryLater (or a prepare() fails), its watermark stays put and
+    the rest of that tag waits for the next scan; the tag is added to `deferred` if a set is passed. The same
+    goes for a finish() hook that raises RetryLater, and for a handler that fails any other
+    way, up to HANDLER_MAX_ATTEMPTS scans, after which the message is skipped. A scan waits for any other scan of
+    the same tags to finish first, then starts from the watermarks that one left.
+    With run_finish=False the finish() hooks are left to the caller (see request_store.refresh_now).
+    Returns {tag: number of messages handled}.
+    """
+    username = username or os.environ.get("EMAIL")
+    password = password or os.environ.get("EMAIL_PASSWORD")
+    tags = [tag for tag in (tags or _handlers) if tag in _handlers]
+    if not tags:
+        return {}
+
+    counts = {}
+    held = set()
+    with ExitStack() as stack:
+        # Always taken in the same order, so scans of overlapping tag sets can't deadlock
+        with _scan_locks_guard:
+            locks = [_scan_locks.setdefault(tag, threading.Lock()) for tag in sorted(tags)]
+        for lock in locks:
+            stack.enter_context(lock)
+
+        _dispatch(tags, username, password, counts, held)
+        for tag in tags if run_finish else ():
+            finish = _handlers[tag][2]
+            if finish is None:
+                continue
+            try:
+                with timed("finish", router=tag.lower().replace(" ", "_")):
+                    finish()
+            except RetryLater as e:
+                logger.warning(f"Deferring the rest of the {tag} work to the next scan: {str(e)}")
+                held.add(tag)
+            except Exception as e:
+                logger.error(f"Error finishing {tag} scan: {str(e)}")
+    if deferred is not None:
+        deferred.update(held)
+    return counts
+
+
+def _dispatch(tags, username, password, counts, held):
+    with imap_session(username, password) as imap_server:
+        uidvalidity = get_uidvalidity(imap_server)
+        watermarks = {tag: current_watermark(tag, uidvalidity) for tag in tags}
+        floor = min(watermarks.values())
+
+        # "n:*" always matches the newest message, even when its UID is below n
+        uids = [uid for uid in uid_search(imap_server, build_search_criteria(tags, floor)) if int(uid) > floor]
+        if not uids:
+            return
+        logger.info(f"Dispatching {len(uids)} new request emails for {', '.join(tags)}")
+
+        prepared = set()
+        # Flags come back with the batched fetch, only when some pipeline wants them
+        flags = {} if any(_handlers[tag][3] for tag in tags) else None
+        messages = fetch_messages(imap_server, uids, uidvalidity=uidvalidity, flags=flags)
+        while True:
+            # Time the batched fetch separately from the handlers it feeds
+            with timed("fetch", router="inbox"):
+                email_id, msg = next(messages, (None, None))
+            if msg is None:
+                break
+            for tag in classify_subject(msg.get("Subject")):
+                if tag not in watermarks or tag in held or int(email_id) <= watermarks[tag]:
+                    continue
+                handle, prepare, _, unseen_only = _handlers[tag]
+                router = tag.lower().replace(" ", "_")
+                if unseen_only and "\\Seen" in flags.get(email_id, ()):
+                    advance_watermark(tag, uidvalidity, email_id)
+                    watermarks[tag] = int(email_id)
+                    continue
+                if prepare is not None and tag not in prepared:
+                    try:
+                        with timed("prepare", router=router):
+                            prepare()
+                    except Exception as e:
+                        # Only this tag waits for the next scan; the others and the finish hooks still run
+                        logger.error(f"Error preparing {tag} scan, deferring its requests: {str(e)}")
+                        held.add(tag)
+                        continue
+                    prepared.add(tag)
+                try:
+                    # Stages timed inside the handler are attributed to this router
+                    with timed("handle", router=router):
+                        handle(imap_server, email_id, msg, username, password)
+                except RetryLater as e:
+                    logger.warning(f"Deferring {tag} email {email_id} and later ones to the next scan: {str(e)}")
+                    held.add(tag)
+                    continue
+                except Exception as e:
+                    attempts = _failures.get((tag, int(email_id)), 0) + 1
+                    if attempts < HANDLER_MAX_ATTEMPTS:
+                        # Most failures are transient, so retry it (and the later ones) next scan
+                        logger.error(f"Error processing {tag} email {email_id}, attempt {attempts} of "
+                                     f"{HANDLER_MAX_ATTEMPTS}, retrying on the next scan: {str(e)}")
+                        _failures[(tag, int(email_id))] = attempts
+                        held.add(tag)
+                        continue
+                    logger.error(f"Giving up on {tag} email {email_id} after {attempts} attempts: {str(e)}")
+                _failures.pop((tag, int(email_id)), None)
+                # Never pick this request up again on the next scan
+                advance_watermark(tag, uidvalidity, email_id)
+                watermarks[tag] = int(email_id)
+                counts[tag] = counts.get(tag, 0) + 1
+
+        # Every tag that wasn't held has seen all its mail up to the newest match, so move
+        # the quiet ones up too; otherwise they keep the next search's floor at their old UID
+        newest = max(int(uid) for uid in uids)
+        for tag in tags:
+            if tag not in held and watermarks[tag] < newest:
+                advance_watermark(tag, uidvalidity, newest)
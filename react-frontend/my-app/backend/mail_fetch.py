@@ -0,0 +1,337 @@
+import email
+import html
+import logging
+import os
+import re
+
+import mail_cache
+from metrics import timed
+from mail_sync import get_uidvalidity
+
+logger = logging.getLogger(__name__)
+
+FETCH_BATCH_SIZE    = int(os.environ.get("IMAP_FETCH_BATCH_SIZE", "50"))   # messages per UID FETCH round trip
+MAIL_CACHE_ENABLED  = os.environ.get("MAIL_CACHE_ENABLED", "true").lower() == "true"
+
+_MESSAGE_START = re.compile(rb"^\d+ \(")
+_LITERAL_KEY   = re.compile(rb"(\S+\[[^\]]*\](?:<\d+>)?|\S+) \{\d+\}$")
+_UID           = re.compile(rb"UID (\d+)")
+_FLAGS         = re.compile(rb"FLAGS \(([^)]*)\)")
+_SCRIPT_STYLE  = re.compile(r"<(script|style)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_LINE_BREAK    = re.compile(r"<\s*(br|/p|/div|/li|/tr|/h\d)\b[^>]*>", re.IGNORECASE)
+_TAG           = re.compile(r"<[^>]+>")
+
+
+def uid_search(imap_server, criteria):
+    """Run a UID SEARCH and return the matching UIDs as bytes, oldest first."""
+    status, data = imap_server.uid("SEARCH", None, criteria)
+    if status != "OK" or not data or not data[0]:
+        return []
+    return data[0].split()
+
+
+def sequence_set(uids):
+    """Collapse UIDs into an IMAP sequence set, e.g. [1, 2, 3, 7] -> b'1:3,7'."""
+    numbers = sorted({int(uid) for uid in uids})
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return b",".join(
+        b"%d" % start if start == end else b"%d:%d" % (start, end)
+        for start, end in ranges
+    )
+
+
+def parse_fetch_response(data):
+    """
+    Walk an imaplib FETCH response and yield one dict per message.
+
+    Literal items (RFC822, BODY[...]) are stored under their item name, and the
+    non-literal attributes (UID, FLAGS, ...) are kept as raw text under "ATTRS".
+    """
+    current = None
+    for item in data:
+        header, literal = item if isinstance(item, tuple) else (item, None)
+        if header is None:
+            continue
+        if _MESSAGE_START.match(header):
+            if current is not None:
+                yield _finish(current)
+            current = {"ATTRS": b"", "_parts": {}}
+        elif current is None:
+            continue
+        current["ATTRS"] += header
+        if literal is not None:
+            # The item name is the token before {n}, e.g. b"1 (UID 5 RFC822 {120}" -> RFC822
+            key_match = _LITERAL_KEY.search(header)
+            key = key_match.group(1).decode().upper() if key_match else "LITERAL"
+            current["_parts"][key] = literal
+    if current is not None:
+        yield _finish(current)
+
+
+def _finish(current):
+    result = current.pop("_parts")
+    uid_match = _UID.search(current["ATTRS"])
+    result["UID"] = uid_match.group(1) if uid_match else None
+    result["ATTRS"] = current["ATTRS"]
+    return result
+
+
+def parse_flags(attrs):
+    """Return the FLAGS of a FETCH response as a set of str, e.g. {"\\Seen"}."""
+    match = _FLAGS.search(attrs)
+    return set(match.group(1).decode(errors="replace").split()) if match else set()
+
+
+def _fetch_chunk(imap_server, uids, items):
+    query = items if b"UID" in items.encode().upper() else items.replace("(", "(UID ", 1)
+    status, data = imap_server.uid("FETCH", sequence_set(uids), query)
+    if status != "OK":
+        logger.error(f"UID FETCH failed for {len(uids)} messages: {status}")
+        return []
+    return [message for message in parse_fetch_response(data) if message["UID"] is not None]
+
+
+def iter_fetch(imap_server, uids, items="(RFC822)", batch_size=FETCH_BATCH_SIZE):
+    """
+    Fetch `items` for `uids` with one UID FETCH per `batch_size` messages,
+    yielding parsed messages chunk by chunk so a large inbox is never held in memory at once.
+    """
+    uids = list(uids)
+    for start in range(0, len(uids), batch_size):
+        yield from _fetch_chunk(imap_server, uids[start:start + batch_size], items)
+
+
+# -------------------------
+# BODYSTRUCTURE handling
+# -------------------------
+
+_TOKEN = re.compile(rb'\s*(\(|\)|"(?:[^"\\]|\\.)*"|\{\d+\}|[^\s()"]+)')
+
+
+def parse_parenthesized(data, pos=0):
+    """Parse one IMAP parenthesized list starting at `data[pos]` into nested Python lists."""
+    stack = [[]]
+    while True:
+        match = _TOKEN.match(data, pos)
+        if not match:
+            raise ValueError("Unterminated parenthesized list")
+        token, pos = match.group(1), match.end()
+        if token == b"(":
+            stack.append([])
+        elif token == b")":
+            finished = stack.pop()
+            stack[-1].append(finished)
+            if len(stack) == 1:
+                return stack[0][0], pos
+        elif token.startswith(b'"'):
+            stack[-1].append(re.sub(rb'\\(.)', rb"\1", token[1:-1]).decode(errors="replace"))
+        elif token.upper() == b"NIL":
+            stack[-1].append(None)
+        elif token.startswith(b"{"):
+            # Literal bodies are split out by imaplib; the value itself is not needed here
+            stack[-1].append("")
+        else:
+            stack[-1].append(token.decode(errors="replace"))
+
+
+def parse_bodystructure(attrs):
+    """Return the BODYSTRUCTURE of a FETCH response as nested lists, or None if absent."""
+    index = attrs.upper().find(b"BODYSTRUCTURE (")
+    if index < 0:
+        return None
+    structure, _ = parse_parenthesized(attrs, index + len(b"BODYSTRUCTURE "))
+    return structure
+
+
+def _is_attachment(part):
+    # Basic text parts: type subtype params id desc encoding size lines md5 disposition ...
+    disposition = part[9] if len(part) > 9 else None
+    return isinstance(disposition, list) and disposition and str(disposition[0]).upper() == "ATTACHMENT"
+
+
+def find_text_part(structure, section="", subtype="PLAIN"):
+    """
+    Locate the first inline text/<subtype> part (text/plain unless told otherwise).
+
+    Returns (section, transfer_encoding, charset), e.g. ("1.1", "QUOTED-PRINTABLE", "utf-8"),
+    or None when the message has no such body.
+    """
+    if structure and isinstance(structure[0], list):
+        children = []
+        for item in structure:
+            if not isinstance(item, list):
+                break
+            children.append(item)
+        for number, child in enumerate(children, 1):
+            found = find_text_part(child, f"{section}.{number}" if section else str(number), subtype)
+            if found:
+                return found
+        return None
+
+    if len(structure) < 7 or _is_attachment(structure):
+        return None
+    if str(structure[0]).upper() != "TEXT" or str(structure[1]).upper() != subtype:
+        return None
+
+    params = structure[2] or []
+    charset = "utf-8"
+    for key, value in zip(params[::2], params[1::2]):
+        if str(key).upper() == "CHARSET" and value:
+            charset = value
+    # A single-part message still addresses its body as section 1
+    return section or "1", (structure[5] or "7BIT").upper(), charset
+
+
+_HEADER_FIELDS = "FROM TO SUBJECT DATE MESSAGE-ID"
+
+
+def _build_text_message(header_bytes, body_bytes, encoding, charset):
+    """Rebuild a plain-text RFC 822 message from the headers and the one fetched part."""
+    raw = (header_bytes or b"").rstrip(b"\r\n")
+    raw += f"\r\nContent-Type: text/plain; charset=\"{charset}\"\r\nContent-Transfer-Encoding: {encoding}\r\n\r\n".encode()
+    return raw.lstrip(b"\r\n") + (body_bytes or b"")
+
+
+def html_to_text(markup):
+    """Strip tags from an HTML body, keeping line breaks, for mails that have no text/plain part."""
+    text = _LINE_BREAK.sub("\n", _SCRIPT_STYLE.sub("", markup))
+    lines = (" ".join(line.split()) for line in html.unescape(_TAG.sub("", text)).splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def _html_as_text(body_bytes, encoding, charset):
+    # Decode the part as sent, then re-encode the stripped text as plain UTF-8
+    part = email.message_from_bytes(_build_text_message(b"", body_bytes, encoding, charset))
+    markup = (part.get_payload(decode=True) or b"").decode(charset, errors="replace")
+    return html_to_text(markup).encode("utf-8")
+
+
+def _fetch_text_chunk(imap_server, uids, flags=None, use_cache=False):
+    """
+    Two round trips per chunk: structure + headers, then only the text/plain sections.
+    Mails without a text/plain part get their text/html part instead, tags stripped.
+    With use_cache, a message whose Message-ID is already in the mail cache (the same mail
+    under a new UID, e.g. after a UIDVALIDITY change or a move) skips the second round trip.
+    """
+    header_key = f"BODY[HEADER.FIELDS ({_HEADER_FIELDS})]"
+    items = "FLAGS BODYSTRUCTURE" if flags is not None else "BODYSTRUCTURE"
+    overview = _fetch_chunk(imap_server, uids, f"({items} BODY.PEEK[HEADER.FIELDS ({_HEADER_FIELDS})])")
+
+    by_section = {}
+    plans = []
+    fallback = []
+    for message in overview:
+        if flags is not None:
+            flags[message["UID"]] = parse_flags(message["ATTRS"])
+        try:
+            structure = parse_bodystructure(message["ATTRS"]) or []
+            text_part = find_text_part(structure)
+            is_html = False
+            if text_part is None:
+                text_part = find_text_part(structure, subtype="HTML")
+                is_html = text_part is not None
+        except (ValueError, IndexError, TypeError):
+            fallback.append(message["UID"])
+            continue
+        plans.append((message["UID"], message.get(header_key), text_part, is_html))
+
+    results = {}
+    if use_cache:
+        message_ids = {
+            uid: email.message_from_bytes(header_bytes or b"").get("Message-ID")
+            for uid, header_bytes, _, _ in plans
+        }
+        known = mail_cache.get_by_message_ids(message_ids.values())
+        for uid, message_id in message_ids.items():
+            if message_id in known:
+                results[uid] = known[message_id]
+        plans = [plan for plan in plans if plan[0] not in results]
+    for uid, _, text_part, _ in plans:
+        if text_part:
+            by_section.setdefault(text_part[0], []).append(uid)
+
+    bodies = {}
+    for section, section_uids in by_section.items():
+        for message in _fetch_chunk(imap_server, section_uids, f"(BODY.PEEK[{section}])"):
+            bodies[message["UID"]] = message.get(f"BODY[{section}]")
+
+    for uid, header_bytes, text_part, is_html in plans:
+        _, encoding, charset = text_part or (None, "7BIT", "utf-8")
+        body = bodies.get(uid, b"")
+        if is_html:
+            body, encoding, charset = _html_as_text(body, encoding, charset), "8BIT", "utf-8"
+        results[uid] = _build_text_message(header_bytes, body, encoding, charset)
+
+    # Structures we could not understand are fetched whole, as before
+    for uid, raw in _fetch_full_chunk(imap_server, fallback):
+        results[uid] = raw
+
+    return [(uid, results[uid]) for uid in uids if uid in results]
+
+
+def _fetch_full_chunk(imap_server, uids, flags=None):
+    if not uids:
+        return []
+    fetched = _fetch_chunk(imap_server, uids, "(FLAGS BODY.PEEK[])" if flags is not None else "(BODY.PEEK[])")
+    if flags is not None:
+        flags.update((message["UID"], parse_flags(message["ATTRS"])) for message in fetched)
+    return [(message["UID"], message["BODY[]"]) for message in fetched if message.get("BODY[]") is not None]
+
+
+def fetch_messages(imap_server, uids, batch_size=FETCH_BATCH_SIZE, with_attachments=False,
+                   mailbox="inbox", uidvalidity=None, use_cache=MAIL_CACHE_ENABLED, flags=None):
+    """
+    Yield (uid, email.message.Message) for every UID, fetched in batches.
+
+    By default only the headers and the first inline text/plain part are downloaded;
+    attachments stay on the server. Pass with_attachments=True for the full message.
+    None of the fetches set \\Seen; use mark_seen for that.
+
+    Messages already in the local mail cache, by UID or by Message-ID, are read from disk
+    instead of the server.
+
+    Pass a dict as `flags` to have it filled with {uid: set of IMAP flags} as each batch is
+    fetched. The flags ride along with the batched FETCH; cached messages, whose flags may
+    have changed since, cost one extra FLAGS fetch per batch.
+    """
+    uids = list(uids)
+    if use_cache and uids and uidvalidity is None:
+        uidvalidity = get_uidvalidity(imap_server, mailbox)
+
+    for start in range(0, len(uids), batch_size):
+        chunk = uids[start:start + batch_size]
+        cached = mail_cache.get_many(chunk, uidvalidity, mailbox, with_attachments) if use_cache else {}
+        missing = [uid for uid in chunk if uid not in cached]
+
+        fetched = {}
+        if missing and with_attachments:
+            fetched = dict(_fetch_full_chunk(imap_server, missing, flags))
+        elif missing:
+            fetched = dict(_fetch_text_chunk(imap_server, missing, flags, use_cache))
+        if flags is not None and cached:
+            for message in _fetch_chunk(imap_server, list(cached), "(FLAGS)"):
+                flags[message["UID"]] = parse_flags(message["ATTRS"])
+
+        messages = {uid: email.message_from_bytes(raw) for uid, raw in {**cached, **fetched}.items()}
+        if use_cache and fetched:
+            mail_cache.put_many(
+                [(uid, messages[uid].get("Message-ID"), raw) for uid, raw in fetched.items()],
+                uidvalidity, mailbox, with_attachments,
+            )
+
+        for uid in chunk:
+            if uid in messages:
+                yield uid, messages[uid]
+
+
+def mark_seen(imap_server, uids):
+    """Set \\Seen on all UIDs with a single UID STORE."""
+    if not uids:
+        return
+    with timed("mark_seen"):
+        imap_server.uid("STORE", sequence_set(uids), "+FLAGS", "(\\Seen)")
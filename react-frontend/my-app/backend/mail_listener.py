@@ -0,0 +1,220 @@
+import email
+import imaplib
+import logging
+import os
+import select
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from imap_pool import IMAPSessionPool, IMAP_SERVER, STALE_ERRORS
+from mail_fetch import uid_search, iter_fetch
+from mail_dispatcher import classify_subject, registered_tags, scan_inbox
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MAIL_IDLE_TIMEOUT   = int(os.environ.get("MAIL_IDLE_TIMEOUT", "1500"))   # re-issue IDLE before Gmail's 29 minute cutoff
+MAIL_POLL_INTERVAL  = int(os.environ.get("MAIL_POLL_INTERVAL", "30"))    # NOOP poll interval when IDLE is unavailable
+MAIL_RETRY_DELAY    = int(os.environ.get("MAIL_RETRY_DELAY", "10"))      # wait before reconnecting after an error
+MAIL_DEFER_DELAY    = int(os.environ.get("MAIL_DEFER_DELAY", "120"))     # rescan after a handler deferred a request
+
+
+class IdleRejected(imaplib.IMAP4.abort):
+    """
+    The server answered IDLE with something other than a continuation. An abort, so the
+    session pool drops the connection instead of reusing it with the IDLE tag outstanding.
+    """
+
+
+class MailListener:
+    """Waits on the inbox with IMAP IDLE (or NOOP polling) and runs one inbox scan when new requests arrive."""
+
+    def __init__(self, username, password, mailbox="inbox"):
+        self.username = username
+        self.password = password
+        self.mailbox = mailbox
+        # A dedicated single-session pool so IDLE never holds a slot the routers need
+        self._pool = IMAPSessionPool(IMAP_SERVER, username, password, max_sessions=1)
+        self._stop = threading.Event()
+        self._thread = None
+        # A single worker, so scans never overlap and a request is never processed twice concurrently
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mail-scan")
+        self._lock = threading.Lock()
+        self._scan_queued = False
+        self._last_uid = None
+        self._use_idle = True
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="mail-listener", daemon=True)
+        self._thread.start()
+        logger.info("Mail listener started")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._executor.shutdown(wait=False)
+        self._pool.close()
+        logger.info("Mail listener stopped")
+
+    # -------------------------
+    # Connection loop
+    # -------------------------
+
+    def _run(self):
+        # Catch up on anything that arrived while the service was down
+        self._wake()
+        while not self._stop.is_set():
+            try:
+                with self._pool.session(self.mailbox) as conn:
+                    try:
+                        if self._last_uid is None:
+                            self._last_uid = self._highest_uid(conn)
+                        while not self._stop.is_set():
+                            if self._use_idle and "IDLE" in conn.capabilities:
+                                self._idle(conn)
+                            else:
+                                self._stop.wait(MAIL_POLL_INTERVAL)
+                                conn.noop()
+                            self._check_new_mail(conn)
+                    except imaplib.IMAP4.abort:
+                        raise
+                    except imaplib.IMAP4.error as e:
+                        # A failed SEARCH or NOOP; as an abort, the pool drops the session and we reconnect
+                        raise imaplib.IMAP4.abort(f"IMAP command failed: {str(e)}") from e
+            except IdleRejected as e:
+                # Only a refused IDLE means the server can't do it; poll from now on
+                logger.warning(f"IMAP IDLE failed, falling back to NOOP polling: {str(e)}")
+                self._use_idle = False
+            except STALE_ERRORS as e:
+                logger.warning(f"Mail listener connection lost: {str(e)}")
+                self._stop.wait(MAIL_RETRY_DELAY)
+            except Exception as e:
+                logger.error(f"Mail listener error: {str(e)}")
+                self._stop.wait(MAIL_RETRY_DELAY)
+
+    def _idle(self, conn):
+        """Block in IDLE until the server reports new mail, the timeout passes, or stop() is called."""
+        tag = conn._new_tag()
+        conn.send(tag + b" IDLE\r\n")
+        response = conn.readline()
+        if not response.startswith(b"+"):
+            raise IdleRejected(f"IDLE rejected: {response!r}")
+
+        deadline = time.monotonic() + MAIL_IDLE_TIMEOUT
+        woke = False
+        try:
+            while not woke and not self._stop.is_set() and time.monotonic() < deadline:
+                # Lines imaplib already buffered (e.g. an EXISTS that came with the continuation)
+                # are invisible to select, so look there first; then check every second so
+                # stop() is honoured promptly
+                ready = (
+                    self._buffered(conn)
+                    or getattr(conn.sock, "pending", lambda: 0)()
+                    or select.select([conn.sock], [], [], 1.0)[0]
+                )
+                if ready:
+                    line = conn.readline()
+                    if not line:
+                        raise imaplib.IMAP4.abort("connection closed during IDLE")
+                    woke = line.rstrip().endswith(b"EXISTS")
+        finally:
+            conn.send(b"DONE\r\n")
+            while True:
+                line = conn.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed while leaving IDLE")
+                if line.startswith(tag):
+                    break
+            # _new_tag registered the tag for imaplib's own response matching, which never ran
+            conn.tagged_commands.pop(tag, None)
+
+    @staticmethod
+    def _buffered(conn):
+        """Whatever imaplib's reader already holds, without blocking for more."""
+        timeout = conn.sock.gettimeout()
+        conn.sock.setblocking(False)
+        try:
+            return conn.file.peek(1)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return b""
+        finally:
+            conn.sock.settimeout(timeout)
+
+    # -------------------------
+    # New mail detection
+    # -------------------------
+
+    def _highest_uid(self, conn):
+        uids = uid_search(conn, "UID *")
+        return max((int(uid) for uid in uids), default=0)
+
+    def _check_new_mail(self, conn):
+        uids = [uid for uid in uid_search(conn, f"UID {self._last_uid + 1}:*") if int(uid) > self._last_uid]
+        if not uids:
+            return
+        tags = set()
+        for message in iter_fetch(conn, uids, "(BODY.PEEK[HEADER.FIELDS (SUBJECT)])"):
+            header = message.get("BODY[HEADER.FIELDS (SUBJECT)]") or b""
+            tags |= classify_subject(email.message_from_bytes(header).get("Subject"))
+        self._last_uid = max(int(uid) for uid in uids)
+        tags &= set(registered_tags())
+        if tags:
+            logger.info(f"New requests arrived for: {', '.join(sorted(tags))}")
+            self._wake()
+
+    def _wake(self):
+        with self._lock:
+            # A queued scan has not started yet, so it will pick this mail up too
+            if self._scan_queued:
+                return
+            self._scan_queued = True
+        self._executor.submit(self._run_scan)
+
+    def _run_scan(self):
+        with self._lock:
+            self._scan_queued = False
+        deferred = set()
+        try:
+            scan_inbox(username=self.username, password=self.password, deferred=deferred)
+        except Exception as e:
+            logger.error(f"Error scanning inbox: {str(e)}")
+        if deferred:
+            # Nothing new may arrive to trigger another scan, so schedule one
+            logger.info(f"Rescanning in {MAIL_DEFER_DELAY}s for deferred {', '.join(sorted(deferred))} requests")
+            timer = threading.Timer(MAIL_DEFER_DELAY, self._wake_unless_stopped)
+            timer.daemon = True
+            timer.start()
+
+    def _wake_unless_stopped(self):
+        if not self._stop.is_set():
+            self._wake()
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def start_mail_listener(username=None, password=None):
+    """Start the shared listener (idempotent) and return it."""
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            _listener = MailListener(username or os.environ.get("EMAIL"), password or os.environ.get("EMAIL_PASSWORD"))
+        _listener.start()
+        return _listener
+
+
+def stop_mail_listener():
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
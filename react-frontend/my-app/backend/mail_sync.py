@@ -0,0 +1,52 @@
+import logging
+import re
+
+import student_db
+
+logger = logging.getLogger(__name__)
+
+_UIDVALIDITY = re.compile(rb"UIDVALIDITY (\d+)")
+
+
+def load_watermark(tag, mailbox="inbox"):
+    """Return (uidvalidity, last_uid) for a tag, or (None, 0) if it has never been synced."""
+    cursor = student_db.cursor()
+    cursor.execute("SELECT uidvalidity, last_uid FROM mail_sync_state WHERE mailbox = ? AND tag = ?", (mailbox, tag))
+    result = cursor.fetchone()
+    return result if result else (None, 0)
+
+
+def advance_watermark(tag, uidvalidity, uid, mailbox="inbox"):
+    """Record `uid` as processed; the stored watermark only ever moves forward within a UIDVALIDITY."""
+    with student_db.transaction() as cursor:
+        cursor.execute('''
+        INSERT INTO mail_sync_state (mailbox, tag, uidvalidity, last_uid, last_updated)
+        VALUES (?, ?, ?, ?, datetime('now'))
+        ON CONFLICT (mailbox, tag) DO UPDATE SET
+            last_uid = CASE WHEN uidvalidity = excluded.uidvalidity
+                            THEN MAX(last_uid, excluded.last_uid) ELSE excluded.last_uid END,
+            uidvalidity = excluded.uidvalidity,
+            last_updated = excluded.last_updated
+        ''', (mailbox, tag, int(uidvalidity), int(uid)))
+
+
+def get_uidvalidity(imap_server, mailbox="inbox"):
+    status, data = imap_server.status(mailbox, "(UIDVALIDITY)")
+    match = _UIDVALIDITY.search(data[0] or b"") if status == "OK" and data else None
+    if not match:
+        raise RuntimeError(f"Could not read UIDVALIDITY for {mailbox}")
+    return int(match.group(1))
+
+
+def current_watermark(tag, uidvalidity, mailbox="inbox"):
+    """
+    Return the last processed UID for a tag under the given UIDVALIDITY.
+
+    When the mailbox's UIDVALIDITY changed, the old watermark is meaningless and
+    0 is returned so the whole mailbox is searched again.
+    """
+    stored_validity, last_uid = load_watermark(tag, mailbox)
+    if stored_validity is not None and stored_validity != uidvalidity:
+        logger.warning(f"UIDVALIDITY of {mailbox} changed ({stored_validity} -> {uidvalidity}), resyncing {tag}")
+        return 0
+    return last_uid
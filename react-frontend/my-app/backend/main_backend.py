@@ -1,27 +1,37 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel
-from typing import List, Optional
-import imaplib
-import email
+from typing import List
 import re
-import sqlite3
+import asyncio
 import uvicorn
 import os
-from email.header import decode_header
 from dotenv import load_dotenv
-import google.generativeai as genai
 import smtplib
 from email.message import EmailMessage
 import mimetypes
-from email.utils import parseaddr
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from noc_backend import router as noc_router
 from Placement_backend import router as placement_router
 from rank_backend import router as rank_router
 from scholarship_backend import router as scholarship_router
+from imap_pool import close_all_pools
+from mail_fetch import mark_seen
+from mail_dispatcher import RetryLater
+from mail_listener import start_mail_listener, stop_mail_listener
+from async_io import run_blocking, map_bounded, use_event_loop, shutdown_blocking_io
+from llm_gateway import generate_async, gateway_stats, LLMUnavailableError
+from email_trim import trim_email_body, trim_stats
+from fast_extract import try_fast_path, fast_path_stats
+from rank_service import rank_index_stats
+import llm_cache
+from extractors import get_extractor
+import request_store
+import student_db
+from migrations import run_migrations
+from metrics import timed, current_router, render_prometheus
 
 load_dotenv()
 
@@ -34,11 +44,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets the admin page show how old a served request list is
+    expose_headers=["X-Requests-Scanned-At", "X-Requests-Age"],
 )
 
-# Configure the Google Generative AI client
-genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
-model = genai.GenerativeModel('gemini-1.5-flash')
+# Request tag used for this router's UID watermark in mail_sync_state
+SYNC_TAG = "BONAFIDE"
 
 # Data models for the API
 class StudentInfo(BaseModel):
@@ -51,29 +62,8 @@ class StudentInfo(BaseModel):
 class BonafideRequest(BaseModel):
     students: List[StudentInfo]
 
-# Step 1: Connect to Gmail and fetch emails with "[BONAFIDE]" in the subject
-def fetch_bonafide_emails(username, password):
-    imap_server = imaplib.IMAP4_SSL("imap.gmail.com")
-    imap_server.login(username, password)
-    imap_server.select("inbox")
-
-    # Search for emails with "[BONAFIDE]" in the subject
-    status, messages = imap_server.search(None, '(SUBJECT "[BONAFIDE]")')
-    email_ids = messages[0].split()
-    emails = []
-
-    for email_id in email_ids:
-        res, msg_data = imap_server.fetch(email_id, "(RFC822)")
-        if res != "OK":
-            continue
-        raw_email = msg_data[0][1]
-        msg = email.message_from_bytes(raw_email)
-        emails.append(msg)
-
-    imap_server.logout()
-    return emails
-
 # Step 2: Extract plain text content from the email
+@timed("parse")
 def extract_plain_text_from_email(msg):
     text_content = ""
     if msg.is_multipart():
@@ -87,19 +77,27 @@ def extract_plain_text_from_email(msg):
                 break
     else:
         text_content = msg.get_payload(decode=True).decode(errors="ignore")
-    return text_content
+    # Quoted history, signatures and footers only cost tokens
+    return trim_email_body(text_content)
 
 # Step 3: Use Google's Generative AI LLM to extract Name and Roll Number from the email text
-def extract_student_info_from_text(email_text):
-    prompt = (
+PROMPT_VERSION = "bonafide-v1"   # bump when the prompt changes so cached extractions are not reused
+
+def build_extraction_prompt(email_text):
+    return (
         "Extract and format exactly like this - Name: <student name>, Roll Number: <roll number>. "
         "Extract from this email:\n\n"
         f"{email_text}"
     )
-    response = model.generate_content(prompt)
-    result = response.text
-    # print(f"Raw LLM output: {result}")  # Debug print
-    return result
+
+async def extract_student_info_from_text_async(email_text):
+    # Awaits Gemini instead of blocking the event loop
+    cached = await run_blocking(llm_cache.get, PROMPT_VERSION, email_text)
+    if cached is not None:
+        return cached
+    response = await generate_async(build_extraction_prompt(email_text))
+    await run_blocking(llm_cache.put, PROMPT_VERSION, email_text, response.text)
+    return response.text
 
 def parse_extraction_result(result_text):
     # First try the formatted pattern
@@ -125,17 +123,8 @@ def parse_extraction_result(result_text):
 
     return name, rollnum
 
-# Step 5: Verify the student information against the database
-def check_student_in_db(rollnum):
-    conn = sqlite3.connect('students.db')
-    cursor = conn.cursor()
-    # Updated column name from rollnum to roll_no
-    cursor.execute("SELECT name FROM students WHERE roll_no=?", (rollnum,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
-
 # Generate a PDF Bonafide Certificate
+@timed("pdf_render")
 def generate_pdf(name, rollnum, output_path):
     c = canvas.Canvas(output_path, pagesize=letter)
     c.setTitle("BONAFIDE CERT")
@@ -146,6 +135,7 @@ def generate_pdf(name, rollnum, output_path):
     print(f"PDF generated at: {output_path}")
 
 # Send an email with the PDF attached
+@timed("smtp_send")
 def send_email_with_attachment(sender, recipient, subject, body, attachment_path):
     msg = EmailMessage()
     msg["Subject"] = subject
@@ -171,32 +161,61 @@ def send_email_with_attachment(sender, recipient, subject, body, attachment_path
         smtp.send_message(msg)
     print(f"Email sent with attachment {attachment_path} to {recipient}.")
 
-# New endpoint to fetch bonafide requests from emails
-@app.get("/fetch-bonafide-requests", response_model=List[StudentInfo])
-async def fetch_bonafide_requests():
-    username = os.environ.get("EMAIL")
-    password = os.environ.get("EMAIL_PASSWORD")
-    emails = fetch_bonafide_emails(username, password)
+async def extract_bonafide_fields(email_texts):
+    """(name, rollnum) per email: the rules first, then the configured extractor, then the line-format prompt."""
+    with timed("llm_extract"):
+        # Well-formed requests are answered by the rule-based extractor without an LLM call
+        extracted = [await run_blocking(try_fast_path, email_text) for email_text in email_texts]
+
+        extractor = get_extractor()
+        # The rest go to the configured extractor (Gemini: several emails per prompt)
+        pending = [i for i, fast in enumerate(extracted) if not fast]
+        if pending:
+            results = await extractor.extract_async([email_texts[i] for i in pending])
+            for i, result in zip(pending, results):
+                if result is not None:
+                    extracted[i] = (result["name"], result["roll_number"])
+
+        # Not even a single-email JSON prompt parsed, use the line-format prompt (concurrently)
+        retry = [i for i, fields in enumerate(extracted) if not fields] if extractor.uses_llm else []
+        outputs = await map_bounded(
+            extract_student_info_from_text_async, [email_texts[i] for i in retry], reraise=(LLMUnavailableError,)
+        )
+        for i, output in zip(retry, outputs):
+            extracted[i] = parse_extraction_result(output) if output else (None, None)
+        return [fields or (None, None) for fields in extracted]
 
-    if not emails:
-        return []
+def store_bonafide_request(imap_server, email_id, msg, username, password):
+    # Only stored here; the whole scan is extracted at once by request_store.extract_stored
+    request_store.store_request(SYNC_TAG, email_id, msg, extract_plain_text_from_email(msg))
+    # The partial fetches use BODY.PEEK, so flag the request as read explicitly, as NOC does
+    mark_seen(imap_server, [email_id])
 
-    students = []
-    for msg in emails:
-        email_text = extract_plain_text_from_email(msg)
-        extraction_result = extract_student_info_from_text(email_text)
-        name, rollnum = parse_extraction_result(extraction_result)
+# Requests are stored and extracted in the background as they arrive (see mail_listener)
+request_store.register_request_handler(SYNC_TAG, store_bonafide_request, extract_bonafide_fields)
 
-        # Check if the student exists in the database
-        verified_name = check_student_in_db(rollnum)
+# New endpoint to fetch bonafide requests from emails
+@app.get("/fetch-bonafide-requests", response_model=List[StudentInfo])
+async def fetch_bonafide_requests(response: Response, refresh: bool = False):
+    current_router.set("bonafide")
+    try:
+        requests, headers = await request_store.current_requests(SYNC_TAG, refresh)
+    except RetryLater:
+        # Over quota or Gemini is down; the admin can refresh once it recovers
+        raise HTTPException(status_code=503, detail="AI extraction is unavailable, please try again shortly")
+    response.headers.update(headers)
 
+    students = []
+    for request in requests:
+        name, rollnum = request["fields"]
+        email_text = request["email_text"]
         students.append(
             StudentInfo(
                 name=name or "Unknown",
                 rollnum=rollnum or "Unknown",
-                email=parseaddr(msg.get("From"))[1],
+                email=request["sender"],
                 email_text=email_text[:200] + "..." if len(email_text) > 200 else email_text,
-                verified=verified_name is not None
+                verified=request["verified_name"] is not None
             )
         )
 
@@ -205,32 +224,39 @@ async def fetch_bonafide_requests():
 # New endpoint to process and send certificates
 @app.post("/send-certificates")
 async def send_certificates(request: BonafideRequest):
+    current_router.set("bonafide")
     username = os.environ.get("EMAIL")
     password = os.environ.get("EMAIL_PASSWORD")
 
     processed_count = 0
 
-    for student in request.students:
-        if not student.verified:
-            continue  # Skip unverified students
+    students = [student for student in request.students if student.verified]  # Skip unverified students
+
+    # Look every student up at once; the records carry everything the certificate needs
+    records = await run_blocking(student_db.get_students, [student.rollnum for student in students])
 
-        # Get the verified name from the database (more accurate than email extraction)
-        verified_name = check_student_in_db(student.rollnum)
-        if not verified_name:
+    for student in students:
+        record = records.get(student.rollnum)
+        if not record:
             continue
 
+        # Use the verified name from the database (more accurate than email extraction)
+        verified_name = record["name"]
+
         # Generate certificate
         pdf_filename = f"{student.rollnum}_bonafide.pdf"
-        generate_pdf(verified_name, student.rollnum, pdf_filename)
+        await run_blocking(generate_pdf, verified_name, student.rollnum, pdf_filename)
 
         # Send email with the certificate
-        send_email_with_attachment(
+        await run_blocking(
+            send_email_with_attachment,
             username,
             student.email,
             "Bonafide Certificate",
             "Please find attached your Bonafide Certificate.",
             pdf_filename
         )
+        await run_blocking(request_store.mark_sent, SYNC_TAG, student.rollnum, student.email)
 
         processed_count += 1
 
@@ -239,6 +265,48 @@ async def send_certificates(request: BonafideRequest):
         content={"message": f"Processed and sent {processed_count} certificates", "count": processed_count}
     )
 
+# How many request emails the rule-based extractor handled without an LLM call,
+# and how many body tokens trimming kept out of the prompts
+@app.get("/extraction-stats")
+async def extraction_stats():
+    return {**fast_path_stats(), **trim_stats()}
+
+# Per-router stage latency histograms and LLM token counters, in Prometheus text format
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    gauges = {f"extraction_{key}": value for key, value in {**fast_path_stats(), **trim_stats()}.items()}
+    for provider, stats in gateway_stats().items():
+        for key in ("calls", "retries", "failures", "rejected", "waiting"):
+            gauges[f"llm_gateway_{provider}_{key}"] = stats[key]
+        gauges[f"llm_gateway_{provider}_circuit_open"] = int(stats["circuit"] == "open")
+    gauges["rank_index_rebuilds"] = rank_index_stats()["rebuilds"]
+    return PlainTextResponse(render_prometheus(gauges))
+
+@app.on_event("startup")
+def migrate_database():
+    # Schema changes happen here, once, so no request path needs to create or probe tables
+    run_migrations()
+
+@app.on_event("startup")
+async def schedule_scan_extractions():
+    # Scan finish() hooks run their extraction on this loop rather than one of their own
+    use_event_loop(asyncio.get_running_loop())
+
+@app.on_event("startup")
+def start_mail_listener_service():
+    # Push-based processing of [RANK] and [SCHOLARSHIP] requests, and pre-extraction of
+    # [BONAFIDE] and [NOC] requests for the admin page, replace the on-demand polling
+    if os.environ.get("RUN_AS_SERVICE", "false").lower() == "true":
+        start_mail_listener()
+
+@app.on_event("shutdown")
+def shutdown_imap_pools():
+    # Stop the mail listener, log out the shared IMAP sessions and close the database connections
+    stop_mail_listener()
+    close_all_pools()
+    student_db.close_all_connections()
+    shutdown_blocking_io()
+
 app.include_router(noc_router)
 app.include_router(placement_router)
 app.include_router(rank_router)
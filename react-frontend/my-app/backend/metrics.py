@@ -0,0 +1,86 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets; anything slower lands in +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Router the current request/handler belongs to, so shared code (mark_seen, the LLM
+# gateway) can attribute its time and tokens without being told
+current_router = contextvars.ContextVar("current_router", default="other")
+
+_lock = threading.Lock()
+_histograms = {}   # (router, stage) -> [bucket counts..., +Inf count, sum]
+_tokens = {}       # router -> {"prompt": n, "output": n, "calls": n}
+
+
+def observe(router, stage, seconds):
+    with _lock:
+        histogram = _histograms.setdefault((router, stage), [0] * (len(BUCKETS) + 1) + [0.0])
+        index = next((i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))
+        histogram[index] += 1
+        histogram[-1] += seconds
+
+
+@contextmanager
+def timed(stage, router=None):
+    """Time the block as `stage` of `router` (default: the current router), even if it raises."""
+    router = router or current_router.get()
+    token = current_router.set(router)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(router, stage, time.perf_counter() - start)
+        current_router.reset(token)
+
+
+def record_tokens(prompt_tokens, output_tokens, router=None):
+    router = router or current_router.get()
+    with _lock:
+        counts = _tokens.setdefault(router, {"prompt": 0, "output": 0, "calls": 0})
+        counts["prompt"] += prompt_tokens or 0
+        counts["output"] += output_tokens or 0
+        counts["calls"] += 1
+
+
+def render_prometheus(gauges=None):
+    """Prometheus text format: stage latency histograms, LLM token counters and any extra gauges."""
+    with _lock:
+        histograms = {key: list(value) for key, value in _histograms.items()}
+        tokens = {router: dict(counts) for router, counts in _tokens.items()}
+
+    lines = [
+        "# HELP pipeline_stage_seconds Time spent in each certificate pipeline stage.",
+        "# TYPE pipeline_stage_seconds histogram",
+    ]
+    for (router, stage), histogram in sorted(histograms.items()):
+        labels = f'router="{router}",stage="{stage}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram):
+            cumulative += count
+            lines.append(f'pipeline_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        cumulative += histogram[len(BUCKETS)]
+        lines.append(f'pipeline_stage_seconds_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f"pipeline_stage_seconds_sum{{{labels}}} {histogram[-1]:.6f}")
+        lines.append(f"pipeline_stage_seconds_count{{{labels}}} {cumulative}")
+
+    lines += [
+        "# HELP llm_tokens_total LLM tokens used, by router and direction.",
+        "# TYPE llm_tokens_total counter",
+    ]
+    for router, counts in sorted(tokens.items()):
+        lines.append(f'llm_tokens_total{{router="{router}",direction="prompt"}} {counts["prompt"]}')
+        lines.append(f'llm_tokens_total{{router="{router}",direction="output"}} {counts["output"]}')
+    lines += ["# HELP llm_calls_total Successful LLM calls, by router.", "# TYPE llm_calls_total counter"]
+    for router, counts in sorted(tokens.items()):
+        lines.append(f'llm_calls_total{{router="{router}"}} {counts["calls"]}')
+
+    for name, value in sorted((gauges or {}).items()):
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
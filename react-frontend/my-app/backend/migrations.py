@@ -0,0 +1,262 @@
+import logging
+import threading
+
+import student_db
+
+logger = logging.getLogger(__name__)
+
+_schema_lock = threading.Lock()
+_student_columns = None   # column names of students, read once after migrating
+_query_builders = {}
+_queries = {}
+
+
+def _columns(cursor):
+    cursor.execute("PRAGMA table_info(students)")
+    return [column[1] for column in cursor.fetchall()]
+
+
+def _canonical_student_columns(cursor):
+    # Older copies of students.db used rollnum and rank; every query now assumes roll_no and college_rank
+    columns = _columns(cursor)
+    for old, new in (("rollnum", "roll_no"), ("rank", "college_rank")):
+        if old in columns and new not in columns:
+            logger.info(f"Renaming students.{old} to {new}")
+            cursor.execute(f'ALTER TABLE students RENAME COLUMN "{old}" TO {new}')
+
+
+def _scholarship_tables(cursor):
+    if "scholarship_eligible" not in _columns(cursor):
+        cursor.execute("ALTER TABLE students ADD COLUMN scholarship_eligible INTEGER DEFAULT 0")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS scholarship_criteria (
+        id INTEGER PRIMARY KEY,
+        min_cgpa REAL NOT NULL,
+        min_attendance REAL NOT NULL,
+        last_updated TEXT
+    )
+    ''')
+    cursor.execute('''
+    INSERT OR IGNORE INTO scholarship_criteria (id, min_cgpa, min_attendance, last_updated)
+    VALUES (1, 8.5, 75.0, datetime('now'))
+    ''')
+
+
+def _mail_sync_state(cursor):
+    # Last processed UID per mailbox and request tag (see mail_sync)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS mail_sync_state (
+        mailbox TEXT NOT NULL,
+        tag TEXT NOT NULL,
+        uidvalidity INTEGER NOT NULL,
+        last_uid INTEGER NOT NULL DEFAULT 0,
+        last_updated TEXT,
+        PRIMARY KEY (mailbox, tag)
+    )
+    ''')
+
+
+def _request_tables(cursor):
+    # Pre-extracted bonafide/NOC requests and when each tag was last scanned (see request_store)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS pending_requests (
+        tag TEXT NOT NULL,
+        message_key TEXT NOT NULL,
+        uid INTEGER NOT NULL,
+        sender TEXT,
+        email_text TEXT,
+        roll_no TEXT,
+        fields TEXT,
+        verified_name TEXT,
+        status TEXT NOT NULL DEFAULT 'new',
+        received_at TEXT,
+        extracted_at TEXT,
+        PRIMARY KEY (tag, message_key)
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_requests_status ON pending_requests (tag, status)")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS pending_request_scans (
+        tag TEXT PRIMARY KEY,
+        scanned_at REAL NOT NULL
+    )
+    ''')
+
+
+def _rank_tracking(cursor):
+    """
+    The rank_changes log and the triggers that append to it whenever a student's CGPA
+    (or department) changes, or a student is added or removed (see ranking.refresh_ranks).
+
+    A row with a NULL student_rowid asks for a full recompute; one is logged when the log
+    is first created, since nothing says the stored ranks are current at that point.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rank_changes'")
+    new_log = cursor.fetchone() is None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS rank_changes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_rowid INTEGER,
+        old_cgpa REAL,
+        new_cgpa REAL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_cgpa ON students (cgpa)")
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS students_cgpa_changed AFTER UPDATE OF cgpa ON students
+    WHEN OLD.cgpa IS NOT NEW.cgpa
+    BEGIN
+        INSERT INTO rank_changes (student_rowid, old_cgpa, new_cgpa) VALUES (NEW.rowid, OLD.cgpa, NEW.cgpa);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS students_added AFTER INSERT ON students
+    BEGIN
+        INSERT INTO rank_changes (student_rowid, old_cgpa, new_cgpa) VALUES (NEW.rowid, NULL, NEW.cgpa);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS students_removed AFTER DELETE ON students
+    BEGIN
+        INSERT INTO rank_changes (student_rowid, old_cgpa, new_cgpa) VALUES (OLD.rowid, OLD.cgpa, NULL);
+    END
+    ''')
+    if "department" in _columns(cursor):
+        # Moving department reshuffles two partitions; simplest to recompute
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS students_department_changed AFTER UPDATE OF department ON students
+        WHEN OLD.department IS NOT NEW.department
+        BEGIN
+            INSERT INTO rank_changes (student_rowid, old_cgpa, new_cgpa) VALUES (NULL, NULL, NULL);
+        END
+        ''')
+    if new_log:
+        cursor.execute("INSERT INTO rank_changes (student_rowid) VALUES (NULL)")
+
+
+def eligibility_sql(cgpa="cgpa", attendance="attendance", min_cgpa="min_cgpa", min_attendance="min_attendance"):
+    """
+    SQL for whether a student meets the scholarship criteria: 1 or 0, never NULL, so a student
+    without a CGPA or attendance is ineligible. Shared by the triggers and update_criteria.
+    """
+    return f"COALESCE({cgpa} >= {min_cgpa} AND {attendance} >= {min_attendance}, 0)"
+
+
+def _eligibility_triggers(cursor):
+    """
+    Keep students.scholarship_eligible current as CGPA and attendance change, so nothing
+    has to rewrite the column before processing requests. Criteria changes are applied by
+    scholarship_backend.update_criteria, to the rows whose status flips.
+    """
+    eligible = f'''COALESCE((
+        SELECT {eligibility_sql("NEW.cgpa", "NEW.attendance")} FROM scholarship_criteria WHERE id = 1
+    ), 0)'''
+    for name, event, condition in (
+        ("students_eligibility_changed", "UPDATE OF cgpa, attendance",
+         "WHEN OLD.cgpa IS NOT NEW.cgpa OR OLD.attendance IS NOT NEW.attendance"),
+        ("students_eligibility_added", "INSERT", ""),
+    ):
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON students
+        {condition}
+        BEGIN
+            UPDATE students SET scholarship_eligible = {eligible}
+            WHERE rowid = NEW.rowid AND scholarship_eligible IS NOT {eligible};
+        END
+        ''')
+    # A criteria change can only flip students whose CGPA or attendance lies between the old and new minimum
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_attendance ON students (attendance)")
+    # Bring the flags in line with the current criteria once; the triggers keep them there
+    cursor.execute(f'''
+    UPDATE students SET scholarship_eligible = eligibility.eligible
+    FROM (
+        SELECT students.rowid AS student_rowid,
+               {eligibility_sql()} AS eligible
+        FROM students, scholarship_criteria WHERE scholarship_criteria.id = 1
+    ) AS eligibility
+    WHERE students.rowid = eligibility.student_rowid AND students.scholarship_eligible IS NOT eligibility.eligible
+    ''')
+
+
+def _department_ranks(cursor):
+    # Ranks within each department, kept apart from college_rank and refreshed along with it
+    # from the rank_changes log (see ranking.refresh_ranks)
+    columns = _columns(cursor)
+    if "department" in columns and "department_rank" not in columns:
+        cursor.execute("ALTER TABLE students ADD COLUMN department_rank INTEGER")
+        # Empty until ranked; ask the next refresh for a full recompute
+        cursor.execute("INSERT INTO rank_changes (student_rowid) VALUES (NULL)")
+
+
+# (version, description, migration); PRAGMA user_version holds the last one applied.
+# Append only: never edit or renumber a migration that has shipped. The early ones use
+# IF NOT EXISTS because databases from before the runner already have some of these objects.
+MIGRATIONS = [
+    (1, "canonical students column names", _canonical_student_columns),
+    (2, "scholarship_eligible column and scholarship_criteria table", _scholarship_tables),
+    (3, "mail_sync_state table", _mail_sync_state),
+    (4, "pending request tables", _request_tables),
+    (5, "rank change log and triggers", _rank_tracking),
+    (6, "scholarship eligibility triggers", _eligibility_triggers),
+    (7, "department_rank column", _department_ranks),
+]
+
+
+def schema_version(cursor):
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+
+def run_migrations():
+    """
+    Apply every migration newer than the database's user_version, each in its own
+    write transaction, then load the schema registry. Run once at startup, before
+    any request touches the database.
+    """
+    applied = schema_version(student_db.cursor())
+    for version, description, migrate in MIGRATIONS:
+        if version <= applied:
+            continue
+        with student_db.transaction(immediate=True) as cursor:
+            # Another process may have migrated while this one waited for the lock
+            if schema_version(cursor) >= version:
+                continue
+            migrate(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+        logger.info(f"Applied schema migration {version}: {description}")
+    _load_schema(reload=True)
+
+
+def _load_schema(reload=False):
+    global _student_columns
+    with _schema_lock:
+        if _student_columns is not None and not reload:
+            return
+        _student_columns = frozenset(_columns(student_db.cursor()))
+        _queries.clear()
+        for name, build in _query_builders.items():
+            _queries[name] = build(_student_columns)
+
+
+def student_columns():
+    """Column names of the students table, as of the last run_migrations()."""
+    _load_schema()
+    return _student_columns
+
+
+def register_query(name, build):
+    """
+    Register a statement whose text depends on the schema. `build(columns)` is called once
+    with the students column names when the schema is loaded, so the same SQL string is
+    reused on every call and stays in each connection's prepared-statement cache.
+    """
+    with _schema_lock:
+        _query_builders[name] = build
+        if _student_columns is not None:
+            _queries[name] = build(_student_columns)
+
+
+def query(name):
+    """The SQL registered as `name`, built for the current schema."""
+    _load_schema()
+    return _queries[name]
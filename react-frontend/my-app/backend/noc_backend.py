@@ -1,14 +1,9 @@
-import imaplib
-import email
 import re
-import sqlite3
 import os
-from email.header import decode_header
 from dotenv import load_dotenv
 from datetime import datetime
 import io
-from fastapi import APIRouter
-import google.generativeai as genai  # Google Generative AI client
+from fastapi import APIRouter, HTTPException, Response
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import inch
@@ -19,25 +14,35 @@ from email.mime.text import MIMEText
 from email import encoders
 from pydantic import BaseModel
 from typing import List
+from email.utils import parseaddr
+from imap_pool import imap_session
+from mail_fetch import mark_seen
+from mail_dispatcher import RetryLater
+from async_io import run_blocking, map_bounded
+from llm_gateway import generate_async, LLMUnavailableError
+from email_trim import trim_email_body
+import llm_cache
+from extractors import get_extractor
+from metrics import timed, current_router
+import request_store
+import student_db
 
 load_dotenv()
 
 EMAIL_ACCOUNT    = os.environ.get("EMAIL")            # e.g., "your_email@gmail.com"
 EMAIL_PASSWORD   = os.environ.get("EMAIL_PASSWORD")     # App Password or actual password
-GOOGLE_API_KEY   = os.environ.get("GOOGLE_API_KEY")       # for Gemini
 IMAP_SERVER      = "imap.gmail.com"
 SMTP_SERVER      = "smtp.gmail.com"
 SMTP_PORT        = 587
 
+# Request tag used for this router's UID watermark in mail_sync_state
+SYNC_TAG = "NOC"
+
 router = APIRouter(
     prefix="/noc",  # Routes under /noc
     tags=["noc"],
 )
 
-# Configure Gemini
-genai.configure(api_key=GOOGLE_API_KEY)
-model = genai.GenerativeModel("gemini-1.5-flash")
-
 class Student(BaseModel):
     name: str
     roll_no: str
@@ -52,47 +57,7 @@ class Student(BaseModel):
 class StudentRequest(BaseModel):
     students: List[Student]
 
-def fetch_noc_emails(username, password):
-    imap_server = imaplib.IMAP4_SSL(IMAP_SERVER)
-    imap_server.login(username, password)
-    imap_server.select("inbox")
-
-    # Updated search criteria:
-    # 1. Subject has [NOC]
-    # 2. NOT FROM the current email account (to exclude sent/replied emails)
-    # 3. Only get UNSEEN (unread) emails to avoid processing previously handled requests
-    search_criteria = f'(SUBJECT "[NOC]" NOT FROM "{username}" UNSEEN)'
-    status, messages = imap_server.search(None, search_criteria)
-    
-    if status != "OK":
-        print("No unread NOC emails found or error in search.")
-        imap_server.logout()
-        return []
-
-    email_ids = messages[0].split()
-    emails = []
-    seen_message_ids = set()
-
-    for email_id in email_ids:
-        res, msg_data = imap_server.fetch(email_id, "(RFC822)")
-        if res != "OK":
-            continue
-        raw_email = msg_data[0][1]
-        msg = email.message_from_bytes(raw_email)
-        msg_id = msg.get("Message-ID")
-        
-        # Skip duplicates
-        if msg_id in seen_message_ids:
-            continue
-        seen_message_ids.add(msg_id)
-        
-        # Store the email_id with the message for later reference
-        msg.email_id = email_id
-        emails.append(msg)
-
-    imap_server.logout()
-    return emails
-
+@timed("parse")
 def extract_plain_text_from_email(msg):
     text_content = ""
     if msg.is_multipart():
@@ -105,10 +70,13 @@ def extract_plain_text_from_email(msg):
                 break
     else:
         text_content = msg.get_payload(decode=True).decode(errors="ignore")
-    return text_content
+    # Quoted history, signatures and footers only cost tokens
+    return trim_email_body(text_content)
 
-def extract_student_info_with_llm(email_text):
-    prompt = f"""
+PROMPT_VERSION = "noc-v1"   # bump when the prompt changes so cached extractions are not reused
+
+def build_extraction_prompt(email_text):
+    return f"""
     You are given an email from a student requesting an NOC.
     Please extract the following fields exactly as separate lines in the format shown:
     Name: <NAME>
@@ -121,9 +89,15 @@ def extract_student_info_with_llm(email_text):
     Email:
     {email_text}
     """
-    response = model.generate_content(prompt)
+
+async def extract_student_info_with_llm_async(email_text):
+    cached = await run_blocking(llm_cache.get, PROMPT_VERSION, email_text)
+    if cached is not None:
+        return cached
+    response = await generate_async(build_extraction_prompt(email_text))
     result = response.text
-    print(f"Raw LLM output:\n{result}\n")
+    # print(f"Raw LLM output:\n{result}\n")  # Debug print
+    await run_blocking(llm_cache.put, PROMPT_VERSION, email_text, result)
     return result
 
 def parse_extraction_result(result_text):
@@ -143,17 +117,18 @@ def parse_extraction_result(result_text):
 
     return name, rollnum, from_date, to_date, pronoun, cgpa
 
-def check_student_in_db(rollnum):
-    if not os.path.exists("students.db"):
-        return None
-    conn = sqlite3.connect("students.db")
-    cursor = conn.cursor()
-    # Use the correct column name 'roll_no'
-    cursor.execute("SELECT name FROM students WHERE roll_no=?", (rollnum,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
-
+def fields_from_batch_result(result):
+    # Same defaults as parse_extraction_result for anything the model left out
+    return (
+        result["name"] or "",
+        result["roll_number"] or "",
+        result["from_date"] or "",
+        result["to_date"] or "",
+        (result["pronoun"] or "his").lower(),
+        result["cgpa"] or "0",
+    )
+
+@timed("pdf_render")
 def generate_noc_pdf_in_memory(name, rollnum, from_date, to_date, pronoun, cgpa):
     buffer = io.BytesIO()
     c = canvas.Canvas(buffer, pagesize=A4)
@@ -203,6 +178,7 @@ def generate_noc_pdf_in_memory(name, rollnum, from_date, to_date, pronoun, cgpa)
     buffer.seek(0)
     return buffer
 
+@timed("smtp_send")
 def send_noc_certificate(to_email, pdf_buffer, name):
     msg = MIMEMultipart()
     msg["From"] = EMAIL_ACCOUNT
@@ -226,76 +202,94 @@ def send_noc_certificate(to_email, pdf_buffer, name):
 
 def mark_emails_as_processed(emails):
     """Mark processed emails as read in the inbox"""
-    imap_server = imaplib.IMAP4_SSL(IMAP_SERVER)
-    imap_server.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
-    imap_server.select("inbox")
-    
-    for msg in emails:
-        if hasattr(msg, 'email_id'):
-            # Mark the email as read
-            imap_server.store(msg.email_id, '+FLAGS', '\\Seen')
-    
-    imap_server.logout()
+    email_ids = [msg.email_id for msg in emails if hasattr(msg, 'email_id')]
+    with imap_session(EMAIL_ACCOUNT, EMAIL_PASSWORD) as imap_server:
+        # Mark all the emails as read with a single UID STORE
+        mark_seen(imap_server, email_ids)
+
+async def extract_noc_fields(email_texts):
+    """The six NOC fields per email, as returned by parse_extraction_result."""
+    with timed("llm_extract"):
+        # Extract student info with the configured extractor (Gemini: several emails per prompt)
+        extractor = get_extractor()
+        results = await extractor.extract_async(email_texts)
+        extracted = [fields_from_batch_result(result) if result is not None else None for result in results]
+
+        # Batch replies that didn't parse get the line-format prompt, concurrently
+        retry = [i for i, fields in enumerate(extracted) if fields is None] if extractor.uses_llm else []
+        outputs = await map_bounded(
+            extract_student_info_with_llm_async, [email_texts[i] for i in retry], reraise=(LLMUnavailableError,)
+        )
+        for i, llm_output in zip(retry, outputs):
+            extracted[i] = parse_extraction_result(llm_output or "")
+        return [fields or parse_extraction_result("") for fields in extracted]
+
+def store_noc_request(imap_server, email_id, msg, username, password):
+    # Same requests the on-demand fetch used to pick: unread (see unseen_only below), not sent
+    # from this account, with a text body
+    if parseaddr(msg.get("From", ""))[1].lower() == (username or "").lower():
+        return
+    email_text = extract_plain_text_from_email(msg)
+    if not email_text.strip():
+        return
+    request_store.store_request(SYNC_TAG, email_id, msg, email_text)
+    # The partial fetches use BODY.PEEK, so flag the request as read explicitly
+    mark_seen(imap_server, [email_id])
+
+# Requests are stored and extracted in the background as they arrive (see mail_listener)
+request_store.register_request_handler(SYNC_TAG, store_noc_request, extract_noc_fields, unseen_only=True)
 
 # GET endpoint to fetch NOC requests from emails
 @router.get("/fetch-noc-requests")
-async def fetch_noc_requests():
-    emails = fetch_noc_emails(EMAIL_ACCOUNT, EMAIL_PASSWORD)
-    print(f"Fetched {len(emails)} unread emails with [NOC].")
-    student_requests = []
-    processed_emails = []
-
-    for msg in emails:
-        # Extract sender email
-        from_header = msg.get("From", "")
-        match = re.search(r"<(.+?)>", from_header)
-        student_email = match.group(1) if match else from_header
-
-        email_text = extract_plain_text_from_email(msg)
-        if not email_text.strip():
-            continue
-
-        # Extract student info using LLM
-        llm_output = extract_student_info_with_llm(email_text)
-        name, rollnum, from_date, to_date, pronoun, cgpa = parse_extraction_result(llm_output)
-        print(f"Extracted details => Name: {name}, Roll: {rollnum}, Period: {from_date} to {to_date}, Pronoun: {pronoun}, CGPA: {cgpa}")
+async def fetch_noc_requests(response: Response, refresh: bool = False):
+    current_router.set("noc")
+    try:
+        requests, headers = await request_store.current_requests(SYNC_TAG, refresh, EMAIL_ACCOUNT, EMAIL_PASSWORD)
+    except RetryLater:
+        # Over quota or Gemini is down; the admin can refresh once it recovers
+        raise HTTPException(status_code=503, detail="AI extraction is unavailable, please try again shortly")
+    response.headers.update(headers)
 
-        verified_name = check_student_in_db(rollnum)
-        verified = True if verified_name else False
-        if verified_name:
-            name = verified_name
+    student_requests = []
+    for request in requests:
+        name, rollnum, from_date, to_date, pronoun, cgpa = request["fields"]
+        verified_name = request["verified_name"]
+        email_text = request["email_text"]
 
         student_obj = {
-            "name": name if name else "Unknown",
+            "name": verified_name or name or "Unknown",
             "roll_no": rollnum if rollnum else "Unknown",
-            "email": student_email,
+            "email": request["sender"],
             "email_text": email_text[:200] + "..." if len(email_text) > 200 else email_text,
-            "verified": verified,
+            "verified": verified_name is not None,
             "from_date": from_date,
             "to_date": to_date,
             "pronoun": pronoun,
             "cgpa": cgpa
         }
         student_requests.append(student_obj)
-        processed_emails.append(msg)
 
     return student_requests
 
 # POST endpoint to send NOC certificates for verified students
 @router.post("/send-noc-certificates")
 async def send_noc_certificates(request_data: StudentRequest):
+    current_router.set("noc")
     processed_count = 0
-    for student in request_data.students:
-        if not student.verified:
-            continue
-        name = student.name
+    students = [student for student in request_data.students if student.verified]
+    # One query for the whole batch; the database name is printed when the student is known
+    records = await run_blocking(student_db.get_students, [student.roll_no for student in students])
+    for student in students:
+        record = records.get(student.roll_no)
+        name = record["name"] if record else student.name
         roll_no = student.roll_no
         from_date = student.from_date
         to_date = student.to_date
         pronoun = student.pronoun
         cgpa = student.cgpa
         email_addr = student.email
-        pdf_buffer = generate_noc_pdf_in_memory(name, roll_no, from_date, to_date, pronoun, cgpa)
-        send_noc_certificate(email_addr, pdf_buffer, name)
+        pdf_buffer = await run_blocking(generate_noc_pdf_in_memory, name, roll_no, from_date, to_date, pronoun, cgpa)
+        await run_blocking(send_noc_certificate, email_addr, pdf_buffer, name)
+        await run_blocking(request_store.mark_sent, SYNC_TAG, roll_no, email_addr)
         processed_count += 1
     return {"message": f"Processed and sent {processed_count} certificates", "count": processed_count}
\ No newline at end of file
@@ -1,24 +1,28 @@
-import imaplib
-import email
 import re
-import sqlite3
 import os
 import time
 import logging
-import shutil
 import sys
-from email.header import decode_header
 from dotenv import load_dotenv
-import google.generativeai as genai
+from mail_fetch import mark_seen
+from mail_dispatcher import register_message_handler, scan_inbox, RetryLater
+from mail_listener import start_mail_listener
+from async_io import run_blocking
+from fast_extract import try_fast_path, names_likely_match
+from extractors import get_extractor, ExtractionPrompt
+from email_trim import trim_email_body
+from metrics import timed
+import student_db
+import rank_service
+from ranking import refresh_ranks, rebuild_ranks
+from llm_gateway import LLMUnavailableError
 import smtplib
 from email.message import EmailMessage
-import mimetypes
 from email.utils import parseaddr
 from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.platypus import Paragraph, SimpleDocTemplate
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 
 # Set up logging
 logging.basicConfig(
@@ -31,16 +35,15 @@ logger = logging.getLogger()
 # Load environment variables
 load_dotenv()
 
-# Configure Gemini AI
-genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
-model = genai.GenerativeModel('gemini-1.5-flash')
-
 # Create certificates directory if it doesn't exist
 CERTIFICATES_DIR = "certificates"
 if not os.path.exists(CERTIFICATES_DIR):
     os.makedirs(CERTIFICATES_DIR)
     logger.info(f"Created certificates directory: {CERTIFICATES_DIR}")
 
+# Request tag used for this router's UID watermark in mail_sync_state
+SYNC_TAG = "RANK"
+
 # Set up the FastAPI router
 router = APIRouter(
     prefix="/ranking",  # Adds this prefix to all routes
@@ -57,71 +60,35 @@ def check_and_process_emails():
         return
     
     try:
-        # Connect to the IMAP server
-        imap_server = imaplib.IMAP4_SSL("imap.gmail.com")
-        imap_server.login(username, password)
-        imap_server.select("inbox")
-        
-        # Search for emails with subject containing "[RANK]"
-        status, messages = imap_server.search(None, '(SUBJECT "[RANK]")')
-        email_ids = messages[0].split()
-        
-        if not email_ids:
+        # One pass over the inbox for new [RANK] requests; see register_message_handler below
+        counts = scan_inbox([SYNC_TAG], username, password)
+        if not counts:
             logger.info("No rank certificate requests found")
-            imap_server.logout()
-            return
-        
-        logger.info(f"Found {len(email_ids)} rank certificate requests")
-        
-        # Update database ranks before processing any emails
-        update_student_ranks()
-        
-        for email_id in email_ids:
-            try:
-                process_single_email(imap_server, email_id, username, password)
-            except Exception as e:
-                logger.error(f"Error processing email {email_id}: {str(e)}")
-        
-        imap_server.logout()
+        else:
+            logger.info(f"Processed {counts[SYNC_TAG]} rank certificate requests")
         
     except Exception as e:
         logger.error(f"Error connecting to email server: {str(e)}")
 
 def update_student_ranks():
-    """Update all student ranks in the database based on sorted CGPA."""
+    """Bring student ranks up to date with CGPA changes since the last call; a no-op when nothing changed."""
     try:
-        conn = sqlite3.connect('students.db')
-        cursor = conn.cursor()
-        
-        # Get all students sorted by CGPA in descending order
-        # Updated query to use roll_no instead of an id column.
-        cursor.execute("SELECT roll_no, cgpa FROM students ORDER BY cgpa DESC, name ASC")
-        student_rows = cursor.fetchall()
-        
-        # Update ranks based on sorted order
-        for rank, (roll_no, _) in enumerate(student_rows, 1):
-            cursor.execute("UPDATE students SET college_rank = ? WHERE roll_no = ?", (rank, roll_no))
-        
-        # Set rank_generation to 1 to indicate ranks have been generated
-        cursor.execute("UPDATE students SET rank_generation = 1")
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"Updated ranks for {len(student_rows)} students")
+        # Taken up front, so a concurrent refresh can't apply the same CGPA changes twice
+        with student_db.transaction(immediate=True) as cursor:
+            # Only the changes logged by the rank_changes triggers are applied (see ranking.refresh_ranks)
+            changed = refresh_ranks(cursor, "college_rank")
+            
+            # Mark that ranks have been generated ('Yes'/'No', as the CHECK constraint requires).
+            # A full-table scan, so only when the log had changes; new students are logged too
+            if changed is not None:
+                cursor.execute("UPDATE students SET rank_generation = 'Yes' WHERE rank_generation IS NOT 'Yes'")
+        if changed:
+            logger.info(f"Updated ranks, {changed} students changed rank")
     except Exception as e:
         logger.error(f"Error updating student ranks: {str(e)}")
 
-def process_single_email(imap_server, email_id, username, password):
+def process_single_email(imap_server, email_id, msg, username, password):
     """Process a single email request using AI for information extraction."""
-    # Fetch the email
-    res, msg_data = imap_server.fetch(email_id, "(RFC822)")
-    if res != "OK":
-        logger.error(f"Failed to fetch email with ID {email_id}")
-        return
-    
-    raw_email = msg_data[0][1]
-    msg = email.message_from_bytes(raw_email)
-    
     # Extract sender information
     sender_email = parseaddr(msg["From"])[1]
     subject = msg["Subject"]
@@ -130,9 +97,18 @@ def process_single_email(imap_server, email_id, username, password):
     # Extract email text content
     email_text = extract_plain_text_from_email(msg)
     
-    # Use AI to extract student information
-    extraction_result = extract_student_info_from_text(email_text)
-    name, rollnum = parse_extraction_result(extraction_result)
+    # Try the rule-based extractor first, and only use AI when it is not confident
+    with timed("llm_extract"):
+        fast = try_fast_path(email_text)
+        if fast:
+            name, rollnum = fast
+        else:
+            # Gemini with this router's prompt, or the offline extractor (see extractors.get_extractor)
+            try:
+                fields = get_extractor(prompt=EXTRACTION_PROMPT).extract([email_text])[0] or {}
+            except LLMUnavailableError as e:
+                raise RetryLater(f"AI extraction unavailable: {str(e)}") from e
+            name, rollnum = fields.get("name"), fields.get("roll_number")
     
     if not rollnum:
         logger.warning(f"Could not extract roll number from email from {sender_email}")
@@ -142,7 +118,7 @@ def process_single_email(imap_server, email_id, username, password):
             "We could not identify your roll number in your request. Please include your name and roll number clearly in your email."
         )
         # Mark as read
-        imap_server.store(email_id, '+FLAGS', '\\Seen')
+        mark_seen(imap_server, [email_id])
         return
     
     # Get student information from database
@@ -156,7 +132,7 @@ def process_single_email(imap_server, email_id, username, password):
             f"We could not find a student with roll number {rollnum} in our database."
         )
         # Mark as read
-        imap_server.store(email_id, '+FLAGS', '\\Seen')
+        mark_seen(imap_server, [email_id])
         return
     
     # Verify name if database has it
@@ -188,20 +164,18 @@ def process_single_email(imap_server, email_id, username, password):
         )
     finally:
         # Mark email as read
-        imap_server.store(email_id, '+FLAGS', '\\Seen')
+        mark_seen(imap_server, [email_id])
 
 def update_rank_certificate_status(rollnum):
     """Update the database to mark rank certificate as generated."""
     try:
-        conn = sqlite3.connect('students.db')
-        cursor = conn.cursor()
-        cursor.execute("UPDATE students SET rank_generation = 1 WHERE roll_no = ?", (rollnum,))
-        conn.commit()
-        conn.close()
+        with student_db.transaction() as cursor:
+            cursor.execute("UPDATE students SET rank_generation = 'Yes' WHERE roll_no = ?", (rollnum,))
         logger.info(f"Updated rank_generation status for student {rollnum}")
     except Exception as e:
         logger.error(f"Error updating rank_generation status: {str(e)}")
 
+@timed("parse")
 def extract_plain_text_from_email(msg):
     """Extract plain text content from an email message."""
     text_content = ""
@@ -229,30 +203,22 @@ def extract_plain_text_from_email(msg):
         except Exception:
             text_content = msg.get_payload(decode=True).decode(errors="ignore")
     
-    return text_content
+    # Quoted history, signatures and footers only cost tokens
+    return trim_email_body(text_content)
 
-def extract_student_info_from_text(email_text):
-    """Use Gemini AI to extract student information from email text."""
-    try:
-        logger.info("Using AI to extract student information")
-        prompt = (
-            "Extract only the following information from this email:\n"
-            "1. Student's full name\n"
-            "2. Student's roll number or ID\n\n"
-            "Format your response exactly like this with no other text:\n"
-            "Name: <extracted student name>\n"
-            "Roll Number: <extracted roll number>\n\n"
-            "If you cannot find one of these pieces of information, use 'Unknown' for that field.\n\n"
-            f"Email text:\n{email_text}"
-        )
-        
-        response = model.generate_content(prompt)
-        result = response.text
-        logger.info(f"AI extraction result: {result}")
-        return result
-    except Exception as e:
-        logger.error(f"Error in AI extraction: {str(e)}")
-        return "Name: Unknown\nRoll Number: Unknown"
+PROMPT_VERSION = "rank-v1"   # bump when the prompt changes so cached extractions are not reused
+
+def build_extraction_prompt(email_text):
+    return (
+        "Extract only the following information from this email:\n"
+        "1. Student's full name\n"
+        "2. Student's roll number or ID\n\n"
+        "Format your response exactly like this with no other text:\n"
+        "Name: <extracted student name>\n"
+        "Roll Number: <extracted roll number>\n\n"
+        "If you cannot find one of these pieces of information, use 'Unknown' for that field.\n\n"
+        f"Email text:\n{email_text}"
+    )
 
 def parse_extraction_result(result_text):
     """Parse the AI extraction result to obtain name and roll number."""
@@ -274,42 +240,31 @@ def parse_extraction_result(result_text):
     logger.info(f"Parsed name: {name}, roll number: {rollnum}")
     return name, rollnum
 
-def names_likely_match(name1, name2):
-    """Check if two names likely refer to the same person."""
-    n1 = ' '.join(name1.lower().split())
-    n2 = ' '.join(name2.lower().split())
-    
-    if n1 == n2:
-        return True
-    if n1 in n2 or n2 in n1:
-        return True
-    
-    words1 = set(n1.split())
-    words2 = set(n2.split())
-    common_words = words1.intersection(words2)
-    
-    if len(common_words) >= 2 or (len(common_words) == 1 and len(words1) == 1 and len(words2) == 1):
-        return True
-        
-    return False
+# Used by GeminiExtractor when EXTRACTOR_BACKEND is gemini
+EXTRACTION_PROMPT = ExtractionPrompt(PROMPT_VERSION, build_extraction_prompt, parse_extraction_result)
 
+@timed("db_verify")
 def get_student_info(rollnum):
     """Retrieve student information from the database."""
     try:
-        conn = sqlite3.connect('students.db')
-        cursor = conn.cursor()
+        cursor = student_db.cursor()
         # Adjust the query as per your database schema using roll_no
         cursor.execute("SELECT name, cgpa, 'Computer Science' as department, college_rank FROM students WHERE roll_no = ?", (rollnum,))
         result = cursor.fetchone()
-        conn.close()
         return result
     except Exception as e:
         logger.error(f"Database error when retrieving student info: {str(e)}")
         return None
 
+@timed("pdf_render")
 def generate_rank_certificate(name, rollnum, cgpa, rank, department, output_path):
     """Generate a professional-looking rank certificate PDF."""
     try:
+        # Rank from the in-memory CGPA index, which can't lag behind CGPA changes like college_rank can
+        standing = rank_service.standing(rollnum)
+        if standing is not None:
+            rank = standing["rank"]
+        
         doc = SimpleDocTemplate(output_path, pagesize=letter)
         styles = getSampleStyleSheet()
         story = []
@@ -354,6 +309,7 @@ def generate_rank_certificate(name, rollnum, cgpa, rank, department, output_path
         logger.error(f"Error generating PDF: {str(e)}")
         raise
 
+@timed("smtp_send")
 def send_certificate_email(username, password, recipient_email, student_name, pdf_path):
     """Send an email with the rank certificate attached."""
     try:
@@ -389,6 +345,7 @@ def send_certificate_email(username, password, recipient_email, student_name, pd
         logger.error(f"Error sending email: {str(e)}")
         raise
 
+@timed("smtp_send")
 def send_error_email(username, password, recipient_email, subject, message):
     """Send an error notification email."""
     try:
@@ -419,45 +376,49 @@ def send_error_email(username, password, recipient_email, subject, message):
         return False
 
 def schedule_periodic_check():
-    """Run the email check periodically."""
-    import schedule
-    import time
-    
-    # Schedule to run every 15 minutes
-    schedule.every(15).minutes.do(check_and_process_emails)
-    
-    logger.info("Starting scheduled email checking service")
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(60)
+    """Start the mail listener, which runs check_and_process_emails as soon as a request arrives."""
+    logger.info("Starting push-based email checking service")
+    start_mail_listener()
+
+# Hand every new [RANK] email from the shared inbox scan to this pipeline,
+# refreshing the database once before the first one
+register_message_handler(SYNC_TAG, process_single_email, prepare=update_student_ranks)
 
 def reset_database_ranks():
     """Reset all ranks in database based on CGPA sorting."""
     try:
-        update_student_ranks()
+        with student_db.transaction(immediate=True) as cursor:
+            rebuild_ranks(cursor, "college_rank")
         print("Database ranks have been reset according to CGPA")
     except Exception as e:
         print(f"Error resetting ranks: {e}")
 
+@router.get("/student/{roll_no}")
+async def student_rank(roll_no: str):
+    """Rank, percentile and number of students ahead for one student, answered from the in-memory CGPA index."""
+    standing = await run_blocking(rank_service.standing, roll_no)
+    if standing is None:
+        raise HTTPException(status_code=404, detail=f"No student with roll number {roll_no}")
+    return standing
+
 @router.get("/rankchecker")
 async def rankcheck():
     """
     API endpoint to process rank certificate requests.
     
     - If a '--reset-ranks' flag is passed via command line, the database ranks are reset.
-    - If RUN_AS_SERVICE is true, the email-check service runs periodically.
+    - If RUN_AS_SERVICE is true, the mail listener is started so requests are processed as they arrive.
     - Otherwise, it updates ranks and processes the emails once.
     """
     try:
         if len(sys.argv) > 1 and sys.argv[1] == "--reset-ranks":
-            reset_database_ranks()
+            await run_blocking(reset_database_ranks)
         elif os.environ.get("RUN_AS_SERVICE", "false").lower() == "true":
             schedule_periodic_check()
         else:
-            update_student_ranks()
+            await run_blocking(update_student_ranks)
             logger.info("Starting AI-powered rank certificate generator")
-            check_and_process_emails()
+            await run_blocking(check_and_process_emails)
             logger.info("Processing complete")
         return {"status": "Processing complete"}
     except Exception as e:
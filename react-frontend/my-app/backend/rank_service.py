@@ -0,0 +1,145 @@
+import bisect
+import logging
+import threading
+import time
+from array import array
+from dotenv import load_dotenv
+
+import student_db
+from migrations import student_columns
+from ranking import RANK_FUNCTION
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class RankIndex:
+    """
+    Every student's CGPA at one point in time: an ascending array('d') for the whole college
+    and one per department, so a rank is two bisections rather than a scan or a stored column.
+    """
+
+    def __init__(self, rows):
+        by_department = {}
+        for cgpa, department in rows:
+            by_department.setdefault(department, []).append(cgpa)
+        self.college = array("d", sorted(cgpa for cgpa, _ in rows))
+        self.departments = {department: array("d", sorted(values)) for department, values in by_department.items()}
+        # DENSE_RANK counts distinct CGPAs above, which needs the distinct values too
+        self.dense = RANK_FUNCTION == "DENSE_RANK"
+        self._distinct = {}
+
+    def _distinct_values(self, key, values):
+        if key not in self._distinct:
+            self._distinct[key] = array("d", sorted(set(values)))
+        return self._distinct[key]
+
+    def _standing(self, key, values, cgpa):
+        at_or_below = bisect.bisect_right(values, cgpa)
+        ahead = len(values) - at_or_below
+        if self.dense:
+            distinct = self._distinct_values(key, values)
+            rank = len(distinct) - bisect.bisect_right(distinct, cgpa) + 1
+        else:
+            # RANK(); ROW_NUMBER's name tie-break isn't in the index, so ties share the higher place
+            rank = ahead + 1
+        return rank, ahead, round(100.0 * at_or_below / len(values), 1), len(values)
+
+    def college_standing(self, cgpa):
+        """(rank, students ahead, percentile, total) among all students."""
+        return self._standing(None, self.college, cgpa)
+
+    def department_standing(self, cgpa, department):
+        """(rank, students ahead, percentile, total) within `department`."""
+        return self._standing(("department", department), self.departments[department], cgpa)
+
+
+class RankService:
+    """
+    Answers rank queries for one student from a RankIndex held in memory.
+
+    The index is rebuilt only when a student's CGPA or department changed, or a student was
+    added or removed, since the last build. Every such write appends to rank_changes (see
+    migrations), so the log's AUTOINCREMENT counter in sqlite_sequence serves as a version
+    number. Unlike MAX(id) it never goes down when refresh_ranks clears the log, and unlike
+    PRAGMA data_version it ignores unrelated writes such as mail watermarks.
+    """
+
+    def __init__(self):
+        self._conn = None
+        self._lock = threading.Lock()
+        self._version = None
+        self._index = None
+        self._has_department = False
+        self.rebuilds = 0
+
+    def _refresh(self):
+        row = self._conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'rank_changes'").fetchone()
+        version = row[0] if row else 0
+        if self._index is not None and version == self._version:
+            return
+        start = time.perf_counter()
+        self._has_department = "department" in student_columns()
+        department = "department" if self._has_department else "NULL"
+        rows = self._conn.execute(f"SELECT cgpa, {department} FROM students WHERE cgpa IS NOT NULL").fetchall()
+        self._index = RankIndex(rows)
+        self._version = version
+        self.rebuilds += 1
+        logger.info(f"Rebuilt rank index over {len(rows)} students in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def standing(self, roll_no):
+        """
+        Return rank, students ahead and percentile (share of students at or below their CGPA)
+        for `roll_no`, college-wide and within their department, or None if there is no such
+        student or they have no CGPA.
+        """
+        with self._lock:
+            if self._conn is None:
+                self._conn = student_db.open_connection()
+            # One read transaction, so the student's row and the index come from the same snapshot
+            self._conn.execute("BEGIN")
+            try:
+                self._refresh()
+                department = "department" if self._has_department else "NULL"
+                row = self._conn.execute(
+                    f"SELECT name, cgpa, {department} FROM students WHERE roll_no = ?", (str(roll_no),)
+                ).fetchone()
+            finally:
+                self._conn.rollback()
+            index, has_department = self._index, self._has_department
+        if row is None or row[1] is None:
+            return None
+        name, cgpa, department = row
+        rank, ahead, percentile, total = index.college_standing(cgpa)
+        standing = {
+            "roll_no": str(roll_no),
+            "name": name,
+            "cgpa": cgpa,
+            "department": department,
+            "rank": rank,
+            "students_ahead": ahead,
+            "percentile": percentile,
+            "total_students": total,
+        }
+        if has_department:
+            rank, ahead, percentile, total = index.department_standing(cgpa, department)
+            standing.update(
+                department_rank=rank,
+                department_students_ahead=ahead,
+                department_percentile=percentile,
+                department_students=total,
+            )
+        return standing
+
+
+_service = RankService()
+
+
+def standing(roll_no):
+    """Rank, percentile and students ahead for one student; see RankService.standing."""
+    return _service.standing(roll_no)
+
+
+def rank_index_stats():
+    return {"rebuilds": _service.rebuilds}
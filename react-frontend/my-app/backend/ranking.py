@@ -0,0 +1,117 @@
+import logging
+import os
+import time
+from dotenv import load_dotenv
+
+from migrations import student_columns
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# How equal CGPAs are ranked: RANK (1, 2, 2, 4), DENSE_RANK (1, 2, 2, 3) or ROW_NUMBER (1, 2, 3, 4, by name)
+RANK_FUNCTION = os.environ.get("RANK_FUNCTION", "RANK").upper()
+RANK_FUNCTIONS = ("RANK", "DENSE_RANK", "ROW_NUMBER")
+
+
+def rank_query(partition_by=None, function=None):
+    """SELECT rowid, roll_no, rank for every student, ranked by CGPA (then name) within `partition_by` if given."""
+    function = (function or RANK_FUNCTION).upper()
+    if function not in RANK_FUNCTIONS:
+        raise ValueError(f"Unknown rank function {function!r}, expected one of {', '.join(RANK_FUNCTIONS)}")
+    partition = f"PARTITION BY {partition_by} " if partition_by else ""
+    # RANK and DENSE_RANK only look at the ORDER BY keys, so name must not break CGPA ties for them
+    order = "cgpa DESC, name ASC" if function == "ROW_NUMBER" else "cgpa DESC"
+    return f"SELECT rowid AS student_rowid, roll_no, {function}() OVER ({partition}ORDER BY {order}) AS new_rank FROM students"
+
+
+def update_ranks(cursor, column="college_rank", partition_by=None, function=None):
+    """
+    Recompute `column` for every student with a single UPDATE ... FROM over a window function.
+
+    Global ranks by default; pass partition_by="department" for ranks within each department.
+    The join is on rowid rather than roll_no, which saves a lookup through the roll_no index
+    per student. Only rows whose rank actually changes are written. Returns the number of rows updated.
+    """
+    start = time.perf_counter()
+    cursor.execute(f'''
+    UPDATE students SET {column} = ranked.new_rank
+    FROM ({rank_query(partition_by, function)}) AS ranked
+    WHERE students.rowid = ranked.student_rowid AND students.{column} IS NOT ranked.new_rank
+    ''')
+    changed = cursor.rowcount
+    scope = f"per {partition_by}" if partition_by else "global"
+    logger.info(f"Recomputed {scope} {column} in {(time.perf_counter() - start) * 1000:.1f} ms, {changed} rows changed")
+    return changed
+
+
+def _apply_single_change(cursor, column, student_rowid, old_cgpa, new_cgpa):
+    """
+    Patch RANK() ranks for one student's CGPA change instead of re-ranking everyone.
+
+    A student's rank is 1 + the number of students with a higher CGPA, so only students
+    whose CGPA lies between the old and new value move, by exactly one place.
+    """
+    if old_cgpa is None:
+        # Added: everyone below the newcomer drops a place
+        shifted = ("+ 1", "cgpa < ?", (new_cgpa,))
+    elif new_cgpa is None:
+        # Removed: everyone who was below them moves up
+        shifted = ("- 1", "cgpa < ?", (old_cgpa,))
+    elif new_cgpa > old_cgpa:
+        shifted = ("+ 1", "cgpa >= ? AND cgpa < ?", (old_cgpa, new_cgpa))
+    else:
+        shifted = ("- 1", "cgpa >= ? AND cgpa < ?", (new_cgpa, old_cgpa))
+    delta, condition, params = shifted
+    cursor.execute(
+        f"UPDATE students SET {column} = {column} {delta} WHERE {condition} AND rowid != ?",
+        params + (student_rowid,),
+    )
+    changed = cursor.rowcount
+    if new_cgpa is not None:
+        cursor.execute(
+            f"UPDATE students SET {column} = 1 + (SELECT COUNT(*) FROM students WHERE cgpa > ?) WHERE rowid = ?",
+            (new_cgpa, student_rowid),
+        )
+        changed += cursor.rowcount
+    return changed
+
+
+def _update_department_ranks(cursor):
+    # department_rank (migration 7) exists only alongside a department column. One CGPA change
+    # can move a student past anyone in their department, so it is always recomputed set-based
+    if "department_rank" in student_columns():
+        update_ranks(cursor, "department_rank", partition_by="department")
+
+
+def refresh_ranks(cursor, column="college_rank"):
+    """
+    Bring global ranks in `column` up to date with the changes the rank_changes triggers
+    (see migrations) logged since the last refresh.
+
+    Does nothing when no CGPA changed. A single change under RANK() only touches the
+    students it moves past; anything else is one set-based recompute. department_rank,
+    where there is one, is recomputed whenever the log has changes. Run it inside
+    student_db.transaction(immediate=True) so two refreshes can't apply the same change.
+    Returns the number of rows updated, or None when no change was logged.
+    """
+    cursor.execute("SELECT id, student_rowid, old_cgpa, new_cgpa FROM rank_changes ORDER BY id")
+    changes = cursor.fetchall()
+    if not changes:
+        return None
+    if len(changes) == 1 and changes[0][1] is not None and RANK_FUNCTION == "RANK":
+        changed = _apply_single_change(cursor, column, *changes[0][1:])
+        logger.info(f"Applied one CGPA change to {column}, {changed} rows changed")
+    else:
+        changed = update_ranks(cursor, column)
+    _update_department_ranks(cursor)
+    cursor.execute("DELETE FROM rank_changes WHERE id <= ?", (changes[-1][0],))
+    return changed
+
+
+def rebuild_ranks(cursor, column="college_rank"):
+    """Recompute every rank (department_rank too) regardless of the change log, and clear it."""
+    changed = update_ranks(cursor, column)
+    _update_department_ranks(cursor)
+    cursor.execute("DELETE FROM rank_changes")
+    return changed
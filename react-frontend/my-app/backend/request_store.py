@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parseaddr
+from dotenv import load_dotenv
+
+import student_db
+from async_io import run_blocking, run_coroutine
+from llm_gateway import LLMUnavailableError
+from mail_dispatcher import register_message_handler, scan_inbox, RetryLater
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+REQUEST_LIST_MAX_AGE = int(os.environ.get("REQUEST_LIST_MAX_AGE", "300"))   # rescan in the background when older (seconds)
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+# tag -> the router's extract_fields coroutine function (see register_request_handler)
+_extractors = {}
+
+
+def register_request_handler(tag, handle, extract_fields, unseen_only=False):
+    """
+    Register `handle` (which stores the request, see store_request) for `tag`, with every scan
+    finished by extracting what it stored. `extract_fields(email_texts)` is the router's coroutine
+    returning a fields tuple per email, with the roll number second.
+    """
+    _extractors[tag] = extract_fields
+    register_message_handler(
+        tag, handle, finish=lambda: run_coroutine(extract_stored(tag)), unseen_only=unseen_only
+    )
+
+
+def store_request(tag, uid, msg, email_text):
+    """Queue a request email for extraction; a message already stored (same Message-ID) is ignored."""
+    message_key = msg.get("Message-ID") or f"uid:{int(uid)}"
+    with student_db.transaction() as cursor:
+        cursor.execute('''
+        INSERT OR IGNORE INTO pending_requests (tag, message_key, uid, sender, email_text, received_at)
+        VALUES (?, ?, ?, ?, ?, datetime('now'))
+        ''', (tag, message_key, int(uid), parseaddr(msg.get("From", ""))[1], email_text))
+
+
+def unextracted_requests(tag):
+    """Return [(message_key, email_text)] for stored requests that have not been extracted yet, oldest first."""
+    cursor = student_db.cursor()
+    cursor.execute(
+        "SELECT message_key, email_text FROM pending_requests WHERE tag = ? AND status = 'new' ORDER BY uid", (tag,)
+    )
+    return cursor.fetchall()
+
+
+def save_extractions(tag, results):
+    """Store [(message_key, roll_no, fields, verified_name)]; `fields` is whatever the router extracted, as a list."""
+    with student_db.transaction() as cursor:
+        cursor.executemany('''
+        UPDATE pending_requests
+        SET roll_no = ?, fields = ?, verified_name = ?, status = 'extracted', extracted_at = datetime('now')
+        WHERE tag = ? AND message_key = ?
+        ''', [
+            (roll_no, json.dumps(list(fields)), verified_name, tag, message_key)
+            for message_key, roll_no, fields, verified_name in results
+        ])
+
+
+def list_requests(tag):
+    """Return the extracted, not yet answered requests for `tag` as dicts, oldest first."""
+    cursor = student_db.cursor()
+    cursor.execute('''
+    SELECT message_key, sender, email_text, fields, verified_name FROM pending_requests
+    WHERE tag = ? AND status = 'extracted' ORDER BY uid
+    ''', (tag,))
+    return [
+        {"message_key": key, "sender": sender, "email_text": text, "fields": json.loads(fields), "verified_name": verified}
+        for key, sender, text, fields, verified in cursor.fetchall()
+    ]
+
+
+def mark_sent(tag, roll_no, sender):
+    """Drop an answered request from the list; returns the number of stored requests it matched."""
+    with student_db.transaction() as cursor:
+        cursor.execute('''
+        UPDATE pending_requests SET status = 'sent'
+        WHERE tag = ? AND status = 'extracted' AND sender = ? AND roll_no = ?
+        ''', (tag, sender, roll_no))
+        return cursor.rowcount
+
+
+def mark_scanned(tag):
+    with student_db.transaction() as cursor:
+        cursor.execute("INSERT OR REPLACE INTO pending_request_scans (tag, scanned_at) VALUES (?, ?)", (tag, time.time()))
+
+
+def last_scanned(tag):
+    """Unix time of the last inbox scan for `tag`, or None if it has never been scanned."""
+    cursor = student_db.cursor()
+    cursor.execute("SELECT scanned_at FROM pending_request_scans WHERE tag = ?", (tag,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def staleness_headers(scanned_at):
+    """Response headers telling the admin page how old the served list is."""
+    if scanned_at is None:
+        return {}
+    return {
+        "X-Requests-Scanned-At": datetime.fromtimestamp(scanned_at, timezone.utc).isoformat(timespec="seconds"),
+        "X-Requests-Age": str(int(time.time() - scanned_at)),
+    }
+
+
+async def extract_stored(tag):
+    """Extract and verify every stored request that hasn't been yet, so the admin list is ready to serve."""
+    await run_blocking(mark_scanned, tag)
+    pending = await run_blocking(unextracted_requests, tag)
+    if not pending:
+        return
+    try:
+        extracted = await _extractors[tag]([email_text for _, email_text in pending])
+    except LLMUnavailableError as e:
+        raise RetryLater(f"AI extraction unavailable: {str(e)}") from e
+    # Verify the whole scan against the database with one query
+    records = await run_blocking(student_db.get_students, [fields[1] for fields in extracted])
+    await run_blocking(save_extractions, tag, [
+        (message_key, fields[1], fields, records[fields[1]]["name"] if fields[1] in records else None)
+        for (message_key, _), fields in zip(pending, extracted)
+    ])
+
+
+def refresh(tag, username=None, password=None):
+    """
+    Scan the inbox for `tag` now, so new requests are stored and extracted.
+    Returns False if extraction had to be deferred (e.g. the LLM is over quota).
+    """
+    deferred = set()
+    scan_inbox([tag], username, password, deferred=deferred)
+    return tag not in deferred
+
+
+async def refresh_now(tag, username=None, password=None):
+    """
+    refresh() for the event loop: the scan runs on the I/O pool and the extraction here,
+    so no pool worker waits on the loop. Returns False if extraction had to be deferred.
+    """
+    deferred = set()
+    await run_blocking(scan_inbox, [tag], username, password, deferred=deferred, run_finish=False)
+    try:
+        await extract_stored(tag)
+    except RetryLater as e:
+        logger.warning(f"Deferring the rest of the {tag} work to the next scan: {str(e)}")
+        return False
+    return tag not in deferred
+
+
+def refresh_in_background(tag, username=None, password=None):
+    """Start a refresh for `tag` unless one is already running."""
+    with _refreshing_lock:
+        if tag in _refreshing:
+            return
+        _refreshing.add(tag)
+
+    def run():
+        try:
+            refresh(tag, username, password)
+        except Exception as e:
+            logger.error(f"Background refresh of {tag} requests failed: {str(e)}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(tag)
+
+    threading.Thread(target=run, name=f"refresh-{tag.lower()}", daemon=True).start()
+
+
+async def current_requests(tag, refresh=False, username=None, password=None):
+    """
+    The fetch endpoints' view of `tag`: rescan first when asked to (or never scanned), start a
+    background rescan when the list is older than REQUEST_LIST_MAX_AGE, and return
+    (list_requests(tag), staleness headers). Raises RetryLater if the rescan had to be deferred.
+    """
+    scanned_at = await run_blocking(last_scanned, tag)
+    if refresh or scanned_at is None:
+        if not await refresh_now(tag, username, password):
+            raise RetryLater(f"{tag} extraction deferred")
+        scanned_at = await run_blocking(last_scanned, tag)
+    elif time.time() - scanned_at > REQUEST_LIST_MAX_AGE:
+        # Nothing is keeping the list current (no mail listener); serve it now and catch up behind it
+        refresh_in_background(tag, username, password)
+    return await run_blocking(list_requests, tag), staleness_headers(scanned_at)
@@ -1,25 +1,28 @@
 from fastapi import APIRouter, HTTPException
 from fastapi.responses import JSONResponse
-import imaplib
-import email
 import re
-import sqlite3
 import os
 import time
 import logging
-import shutil
-from email.header import decode_header
 from dotenv import load_dotenv
-import google.generativeai as genai
+from mail_fetch import mark_seen
+from mail_dispatcher import register_message_handler, scan_inbox, RetryLater
+from mail_listener import start_mail_listener
+from async_io import run_blocking
+from fast_extract import try_fast_path, names_likely_match
+from extractors import get_extractor, ExtractionPrompt
+from email_trim import trim_email_body
+from metrics import timed
+import student_db
+from migrations import register_query, query, eligibility_sql
+from ranking import refresh_ranks, rebuild_ranks
+from llm_gateway import LLMUnavailableError
 import smtplib
 from email.message import EmailMessage
-import mimetypes
 from email.utils import parseaddr
 from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer
-from reportlab.lib import colors
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, 
@@ -30,37 +33,24 @@ logger = logging.getLogger()
 # Load environment variables
 load_dotenv()
 
-# Configure Gemini AI
-genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
-model = genai.GenerativeModel('gemini-1.5-flash')
-
 # Create certificates directory if it doesn't exist
 CERTIFICATES_DIR = "scholarship_certificates"
 if not os.path.exists(CERTIFICATES_DIR):
     os.makedirs(CERTIFICATES_DIR)
     logger.info(f"Created certificates directory: {CERTIFICATES_DIR}")
 
+# Request tag used for this router's UID watermark in mail_sync_state
+SYNC_TAG = "SCHOLARSHIP"
+
+# The single criteria row, created with its defaults by the schema migrations
+CRITERIA_QUERY = "SELECT min_cgpa, min_attendance FROM scholarship_criteria WHERE id = 1"
+
 # Set up the FastAPI router
 router = APIRouter(
     prefix="/scholarship",
     tags=["scholarship"],
 )
 
-def check_dependencies():
-    """Check if all required packages are installed and install if missing"""
-    try:
-        import schedule
-    except ImportError:
-        logger.info("Schedule package not found. Attempting to install...")
-        try:
-            import subprocess
-            subprocess.check_call(["pip", "install", "schedule"])
-            logger.info("Schedule package installed successfully.")
-        except Exception as e:
-            logger.error(f"Failed to install schedule package: {str(e)}")
-            logger.error("Please install manually with: pip install schedule")
-            exit(1)
-
 def check_and_process_emails():
     """Main function to check emails and process scholarship certificate requests using AI"""
     username = os.environ.get("EMAIL")
@@ -71,111 +61,18 @@ def check_and_process_emails():
         return
     
     try:
-        # Connect to the IMAP server
-        imap_server = imaplib.IMAP4_SSL("imap.gmail.com")
-        imap_server.login(username, password)
-        imap_server.select("inbox")
-        
-        # Search for ALL emails with [SCHOLARSHIP] in the subject (both read and unread)
-        status, messages = imap_server.search(None, 'SUBJECT "[SCHOLARSHIP]"')
-        email_ids = messages[0].split()
-        
-        if not email_ids:
+        # One pass over the inbox for new [SCHOLARSHIP] requests; see register_message_handler below
+        counts = scan_inbox([SYNC_TAG], username, password)
+        if not counts:
             logger.info("No scholarship certificate requests found")
-            imap_server.logout()
-            return
-        
-        logger.info(f"Found {len(email_ids)} scholarship certificate requests")
-        
-        # Update scholarship eligibility before processing any emails
-        update_scholarship_eligibility()
-        
-        for email_id in email_ids:
-            try:
-                process_single_email(imap_server, email_id, username, password)
-            except Exception as e:
-                logger.error(f"Error processing email {email_id}: {str(e)}")
-        
-        imap_server.logout()
+        else:
+            logger.info(f"Processed {counts[SYNC_TAG]} scholarship certificate requests")
         
     except Exception as e:
         logger.error(f"Error connecting to email server: {str(e)}")
 
-def update_scholarship_eligibility():
-    """Update scholarship eligibility for all students"""
-    try:
-        conn = sqlite3.connect('students.db')
-        cursor = conn.cursor()
-        
-        # Check if the scholarship_eligible column exists
-        cursor.execute("PRAGMA table_info(students)")
-        columns = cursor.fetchall()
-        column_names = [col[1] for col in columns]
-        
-        # Add the scholarship_eligible column if it doesn't exist
-        if 'scholarship_eligible' not in column_names:
-            logger.info("Adding scholarship_eligible column to students table")
-            cursor.execute("ALTER TABLE students ADD COLUMN scholarship_eligible INTEGER DEFAULT 0")
-        
-        # Check if scholarship_criteria table exists
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='scholarship_criteria'")
-        table_exists = cursor.fetchone()
-        
-        # Create scholarship_criteria table if it doesn't exist
-        if not table_exists:
-            logger.info("Creating scholarship_criteria table")
-            cursor.execute('''
-            CREATE TABLE scholarship_criteria (
-                id INTEGER PRIMARY KEY,
-                min_cgpa REAL NOT NULL,
-                min_attendance REAL NOT NULL,
-                last_updated TEXT
-            )
-            ''')
-            cursor.execute('''
-            INSERT INTO scholarship_criteria (id, min_cgpa, min_attendance, last_updated)
-            VALUES (1, 8.5, 75.0, datetime('now'))
-            ''')
-            conn.commit()
-        
-        # Get current criteria
-        cursor.execute("SELECT min_cgpa, min_attendance FROM scholarship_criteria WHERE id = 1")
-        criteria = cursor.fetchone()
-        if not criteria:
-            logger.error("Scholarship criteria not found")
-            conn.close()
-            return
-        
-        min_cgpa, min_attendance = criteria
-        
-        # Update eligibility flags
-        cursor.execute('''
-        UPDATE students
-        SET scholarship_eligible = CASE
-            WHEN cgpa >= ? AND attendance >= ? THEN 1
-            ELSE 0
-        END
-        ''', (min_cgpa, min_attendance))
-        
-        conn.commit()
-        rows_updated = cursor.rowcount
-        logger.info(f"Updated scholarship eligibility for {rows_updated} students")
-        
-        conn.close()
-    except Exception as e:
-        logger.error(f"Error updating scholarship eligibility: {str(e)}")
-
-def process_single_email(imap_server, email_id, username, password):
+def process_single_email(imap_server, email_id, msg, username, password):
     """Process a single email request using AI for information extraction"""
-    # Fetch the email
-    res, msg_data = imap_server.fetch(email_id, "(RFC822)")
-    if res != "OK":
-        logger.error(f"Failed to fetch email with ID {email_id}")
-        return
-    
-    raw_email = msg_data[0][1]
-    msg = email.message_from_bytes(raw_email)
-    
     # Extract sender information
     sender_email = parseaddr(msg["From"])[1]
     subject = msg["Subject"]
@@ -184,15 +81,26 @@ def process_single_email(imap_server, email_id, username, password):
     # Extract email text content
     email_text = extract_plain_text_from_email(msg)
     
-    # Use AI to extract student information
-    extraction_result = extract_student_info_from_text(email_text)
-    name, roll_no = parse_extraction_result(extraction_result)
+    # Try the rule-based extractor first, and only use AI when it is not confident
+    with timed("llm_extract"):
+        fast = try_fast_path(email_text)
+        if fast:
+            name, roll_no = fast
+        else:
+            # Gemini with this router's prompt, or the offline extractor (see extractors.get_extractor)
+            try:
+                fields = get_extractor(prompt=EXTRACTION_PROMPT).extract([email_text])[0] or {}
+            except LLMUnavailableError as e:
+                raise RetryLater(f"AI extraction unavailable: {str(e)}") from e
+            name, roll_no = fields.get("name"), fields.get("roll_number")
     
     if not roll_no:
         logger.warning(f"Could not extract roll number from email from {sender_email}")
         send_error_email(username, password, sender_email, 
                          "Student Information Not Found", 
                          "We could not identify your roll number in your request. Please include your name and roll number clearly in your email.")
+        # Mark as read; the partial fetches use BODY.PEEK and leave that to us
+        mark_seen(imap_server, [email_id])
         return
     
     # Get student information from database
@@ -203,6 +111,8 @@ def process_single_email(imap_server, email_id, username, password):
         send_error_email(username, password, sender_email, 
                         "Student Not Found", 
                         f"We could not find a student with roll number {roll_no} in our database.")
+        # Mark as read
+        mark_seen(imap_server, [email_id])
         return
     
     # Verify name if database has it
@@ -217,6 +127,8 @@ def process_single_email(imap_server, email_id, username, password):
     if not is_eligible:
         logger.info(f"Student {roll_no} is not eligible for scholarship (CGPA: {cgpa}, Attendance: {attendance})")
         send_ineligibility_email(username, password, sender_email, db_name, cgpa, attendance)
+        # Mark as read
+        mark_seen(imap_server, [email_id])
         return
     
     # Generate certificate
@@ -239,22 +151,22 @@ def process_single_email(imap_server, email_id, username, password):
         send_error_email(username, password, sender_email, 
                         "Certificate Generation Failed", 
                         "We encountered an error while generating your scholarship certificate. Please contact the administrator.")
+    finally:
+        # Mark email as read
+        mark_seen(imap_server, [email_id])
 
 def update_certificate_status(roll_no):
     """Update the database to record that a certificate was issued"""
     try:
-        conn = sqlite3.connect('students.db')
-        cursor = conn.cursor()
-        
-        # Update the scholarship_certificate field to 1 (indicating a certificate was issued)
-        cursor.execute("UPDATE students SET scholarship_certificate = 1 WHERE roll_no = ?", (roll_no,))
+        with student_db.transaction() as cursor:
+            # Record the issued certificate ('Yes'/'No', as the CHECK constraint requires)
+            cursor.execute("UPDATE students SET scholarship_certificate = 'Yes' WHERE roll_no = ?", (roll_no,))
         
-        conn.commit()
-        conn.close()
-        logger.info(f"Updated certificate status for student {roll_no}")
+            logger.info(f"Updated certificate status for student {roll_no}")
     except Exception as e:
         logger.error(f"Error updating certificate status: {str(e)}")
 
+@timed("parse")
 def extract_plain_text_from_email(msg):
     """Extract plain text content from email message"""
     text_content = ""
@@ -282,30 +194,22 @@ def extract_plain_text_from_email(msg):
         except Exception:
             text_content = msg.get_payload(decode=True).decode(errors="ignore")
     
-    return text_content
+    # Quoted history, signatures and footers only cost tokens
+    return trim_email_body(text_content)
 
-def extract_student_info_from_text(email_text):
-    """Use Gemini AI to extract student information from email text"""
-    try:
-        logger.info("Using AI to extract student information")
-        prompt = (
-            "Extract only the following information from this email:\n"
-            "1. Student's full name\n"
-            "2. Student's roll number or ID\n\n"
-            "Format your response exactly like this with no other text:\n"
-            "Name: <extracted student name>\n"
-            "Roll Number: <extracted roll number>\n\n"
-            "If you cannot find one of these pieces of information, use 'Unknown' for that field.\n\n"
-            f"Email text:\n{email_text}"
-        )
-        
-        response = model.generate_content(prompt)
-        result = response.text
-        logger.info(f"AI extraction result: {result}")
-        return result
-    except Exception as e:
-        logger.error(f"Error in AI extraction: {str(e)}")
-        return "Name: Unknown\nRoll Number: Unknown"
+PROMPT_VERSION = "scholarship-v1"   # bump when the prompt changes so cached extractions are not reused
+
+def build_extraction_prompt(email_text):
+    return (
+        "Extract only the following information from this email:\n"
+        "1. Student's full name\n"
+        "2. Student's roll number or ID\n\n"
+        "Format your response exactly like this with no other text:\n"
+        "Name: <extracted student name>\n"
+        "Roll Number: <extracted roll number>\n\n"
+        "If you cannot find one of these pieces of information, use 'Unknown' for that field.\n\n"
+        f"Email text:\n{email_text}"
+    )
 
 def parse_extraction_result(result_text):
     """Parse the AI extraction result to get name and roll number"""
@@ -327,57 +231,28 @@ def parse_extraction_result(result_text):
     logger.info(f"Parsed name: {name}, roll number: {roll_no}")
     return name, roll_no
 
-def names_likely_match(name1, name2):
-    """Check if two names are likely to refer to the same person"""
-    n1 = ' '.join(name1.lower().split())
-    n2 = ' '.join(name2.lower().split())
-    
-    if n1 == n2:
-        return True
-    if n1 in n2 or n2 in n1:
-        return True
-    
-    words1 = set(n1.split())
-    words2 = set(n2.split())
-    common_words = words1.intersection(words2)
-    
-    if len(common_words) >= 2 or (len(common_words) == 1 and len(words1) == 1 and len(words2) == 1):
-        return True
-        
-    return False
+# Used by GeminiExtractor when EXTRACTOR_BACKEND is gemini
+EXTRACTION_PROMPT = ExtractionPrompt(PROMPT_VERSION, build_extraction_prompt, parse_extraction_result)
 
+def _student_info_query(columns):
+    # Databases without a department column report every student under Engineering, ranked college-wide
+    department = "department" if "department" in columns else "'Engineering' as department"
+    rank = "department_rank" if "department_rank" in columns else "college_rank"
+    return f"""
+    SELECT name, cgpa, attendance, {department}, {rank}, scholarship_eligible
+    FROM students WHERE roll_no = ?
+    """
+
+# Built once from the migrated schema rather than probing PRAGMA table_info on every lookup
+register_query("scholarship_student", _student_info_query)
+
+@timed("db_verify")
 def get_student_info(roll_no):
     """Get student information from the database"""
     try:
-        conn = sqlite3.connect('students.db')
-        cursor = conn.cursor()
-        
-        # Check column names in the students table
-        cursor.execute("PRAGMA table_info(students)")
-        columns = cursor.fetchall()
-        column_names = [col[1] for col in columns]
-        
-        # Determine which column name to use for roll number
-        roll_field = "roll_no" if "roll_no" in column_names else "rollnum"
-        
-        # Check if department field exists
-        dept_field = "department" if "department" in column_names else "'Engineering' as department"
-        
-        # Check if rank field exists
-        rank_field = "college_rank" if "college_rank" in column_names else "rank"
-        
-        # Check if scholarship_eligible field exists
-        eligible_field = "scholarship_eligible" if "scholarship_eligible" in column_names else "1 as scholarship_eligible"
-        
-        # Build query based on available columns
-        query = f"""
-        SELECT name, cgpa, attendance, {dept_field}, {rank_field}, {eligible_field}
-        FROM students WHERE {roll_field} = ?
-        """
-        
-        cursor.execute(query, (roll_no,))
+        cursor = student_db.cursor()
+        cursor.execute(query("scholarship_student"), (roll_no,))
         result = cursor.fetchone()
-        conn.close()
         return result
     except Exception as e:
         logger.error(f"Database error when retrieving student info: {str(e)}")
@@ -386,47 +261,14 @@ def get_student_info(roll_no):
 def get_scholarship_criteria():
     """Get current scholarship criteria from database"""
     try:
-        conn = sqlite3.connect('students.db')
-        cursor = conn.cursor()
-        
-        # Check if scholarship_criteria table exists
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='scholarship_criteria'")
-        table_exists = cursor.fetchone()
-        
-        # Create and populate with default values if it doesn't exist
-        if not table_exists:
-            cursor.execute('''
-            CREATE TABLE scholarship_criteria (
-                id INTEGER PRIMARY KEY,
-                min_cgpa REAL NOT NULL,
-                min_attendance REAL NOT NULL,
-                last_updated TEXT
-            )
-            ''')
-            cursor.execute('''
-            INSERT INTO scholarship_criteria (id, min_cgpa, min_attendance, last_updated)
-            VALUES (1, 8.5, 75.0, datetime('now'))
-            ''')
-            conn.commit()
-            result = (8.5, 75.0)
-        else:
-            cursor.execute("SELECT min_cgpa, min_attendance FROM scholarship_criteria WHERE id = 1")
-            result = cursor.fetchone()
-            if not result:
-                # Insert default values if no row exists
-                cursor.execute('''
-                INSERT INTO scholarship_criteria (id, min_cgpa, min_attendance, last_updated)
-                VALUES (1, 8.5, 75.0, datetime('now'))
-                ''')
-                conn.commit()
-                result = (8.5, 75.0)
-        
-        conn.close()
-        return result
+        cursor = student_db.cursor()
+        cursor.execute(CRITERIA_QUERY)
+        return cursor.fetchone() or (8.5, 75.0)
     except Exception as e:
         logger.error(f"Error retrieving scholarship criteria: {str(e)}")
         return (8.5, 75.0)  # Default values if error
 
+@timed("pdf_render")
 def generate_scholarship_certificate(name, roll_no, cgpa, attendance, rank, department, output_path):
     """Generate a professional-looking scholarship certificate PDF"""
     try:
@@ -483,6 +325,7 @@ the academic scholarship for the current term."""
         logger.error(f"Error generating PDF: {str(e)}")
         raise
 
+@timed("smtp_send")
 def send_certificate_email(username, password, recipient_email, student_name, pdf_path):
     """Send an email with the scholarship certificate attached"""
     try:
@@ -530,6 +373,7 @@ def send_certificate_email(username, password, recipient_email, student_name, pd
         logger.error(f"Error sending email: {str(e)}")
         raise
 
+@timed("smtp_send")
 def send_ineligibility_email(username, password, recipient_email, student_name, cgpa, attendance):
     """Send an email informing the student they are not eligible for the scholarship"""
     try:
@@ -575,6 +419,7 @@ def send_ineligibility_email(username, password, recipient_email, student_name,
         logger.error(f"Error sending ineligibility email: {str(e)}")
         return False
 
+@timed("smtp_send")
 def send_error_email(username, password, recipient_email, subject, message):
     """Send an error notification email"""
     try:
@@ -608,133 +453,83 @@ def send_error_email(username, password, recipient_email, subject, message):
         return False
 
 def schedule_periodic_check():
-    """Run the email check periodically"""
-    import schedule
-    import time
-    
-    # Schedule to run every 15 minutes
-    schedule.every(15).minutes.do(check_and_process_emails)
-    
-    logger.info("Starting scheduled email checking service")
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(60)  # Sleep for 1 minute between checks
+    """Start the mail listener, which runs check_and_process_emails as soon as a request arrives."""
+    logger.info("Starting push-based email checking service")
+    start_mail_listener()
+
+def refresh_student_ranks():
+    """Apply the CGPA changes logged since the last refresh to the ranks certificates print."""
+    with student_db.transaction(immediate=True) as cursor:
+        refresh_ranks(cursor, "college_rank")
+
+# Hand every new [SCHOLARSHIP] email from the shared inbox scan to this pipeline, bringing the
+# ranks up to date once before the first one. Triggers keep scholarship_eligible current (see migrations)
+register_message_handler(SYNC_TAG, process_single_email, prepare=refresh_student_ranks)
 
 def update_criteria(new_min_cgpa=None, new_min_attendance=None):
-    """Update scholarship criteria in the database"""
+    """
+    Update scholarship criteria in the database and re-evaluate the students they affect.
+    Returns the number of students whose eligibility changed, or None if the update failed.
+    """
     try:
-        conn = sqlite3.connect('students.db')
-        cursor = conn.cursor()
-        
-        # Check if scholarship_criteria table exists
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='scholarship_criteria'")
-        table_exists = cursor.fetchone()
-        
-        # Create the table if it doesn't exist
-        if not table_exists:
-            cursor.execute('''
-            CREATE TABLE scholarship_criteria (
-                id INTEGER PRIMARY KEY,
-                min_cgpa REAL NOT NULL,
-                min_attendance REAL NOT NULL,
-                last_updated TEXT
-            )
-            ''')
-            cursor.execute('''
-            INSERT INTO scholarship_criteria (id, min_cgpa, min_attendance, last_updated)
-            VALUES (1, 8.5, 75.0, datetime('now'))
-            ''')
-            conn.commit()
-            current_cgpa, current_attendance = 8.5, 75.0
-        else:
-            # Get current criteria
-            cursor.execute("SELECT min_cgpa, min_attendance FROM scholarship_criteria WHERE id = 1")
+        # Taken up front, so a concurrent change can't slip in between reading and applying the criteria
+        with student_db.transaction(immediate=True) as cursor:
+            cursor.execute(CRITERIA_QUERY)
             current = cursor.fetchone()
-            
             if not current:
-                # Insert default values if no row exists
-                cursor.execute('''
-                INSERT INTO scholarship_criteria (id, min_cgpa, min_attendance, last_updated)
-                VALUES (1, 8.5, 75.0, datetime('now'))
-                ''')
-                conn.commit()
-                current_cgpa, current_attendance = 8.5, 75.0
-            else:
-                current_cgpa, current_attendance = current
-        
-        # Use new values if provided, otherwise keep current values
-        min_cgpa = new_min_cgpa if new_min_cgpa is not None else current_cgpa
-        min_attendance = new_min_attendance if new_min_attendance is not None else current_attendance
-        
-        # Update criteria
-        cursor.execute('''
-        UPDATE scholarship_criteria 
-        SET min_cgpa = ?, min_attendance = ?, last_updated = datetime('now')
-        WHERE id = 1
-        ''', (min_cgpa, min_attendance))
-        
-        conn.commit()
-        conn.close()
-        
-        logger.info(f"Scholarship criteria updated: CGPA >= {min_cgpa}, Attendance >= {min_attendance}%")
-        return True
-        
+                logger.error("Scholarship criteria not found")
+                return None
+            old_cgpa, old_attendance = current
+
+            # Use new values if provided, otherwise keep current values
+            min_cgpa = new_min_cgpa if new_min_cgpa is not None else old_cgpa
+            min_attendance = new_min_attendance if new_min_attendance is not None else old_attendance
+
+            cursor.execute('''
+            UPDATE scholarship_criteria
+            SET min_cgpa = ?, min_attendance = ?, last_updated = datetime('now')
+            WHERE id = 1
+            ''', (min_cgpa, min_attendance))
+
+            # Only students whose CGPA or attendance lies between the old and new minimum can
+            # flip (found through the cgpa and attendance indexes), and only those that do are written
+            # Same expression as the eligibility triggers, so NULL CGPA or attendance gives 0 here too
+            eligible = eligibility_sql(min_cgpa=":cgpa", min_attendance=":attendance")
+            cursor.execute(f'''
+            UPDATE students SET scholarship_eligible = {eligible}
+            WHERE ((cgpa >= :low_cgpa AND cgpa < :high_cgpa)
+                   OR (attendance >= :low_attendance AND attendance < :high_attendance))
+              AND scholarship_eligible IS NOT {eligible}
+            ''', {
+                "cgpa": min_cgpa,
+                "attendance": min_attendance,
+                "low_cgpa": min(old_cgpa, min_cgpa),
+                "high_cgpa": max(old_cgpa, min_cgpa),
+                "low_attendance": min(old_attendance, min_attendance),
+                "high_attendance": max(old_attendance, min_attendance),
+            })
+            changed = cursor.rowcount
+
+            logger.info(f"Scholarship criteria updated: CGPA >= {min_cgpa}, Attendance >= {min_attendance}%, "
+                        f"{changed} students changed eligibility")
+            return changed
+
     except Exception as e:
         logger.error(f"Error updating scholarship criteria: {str(e)}")
-        return False
+        return None
 
 def update_student_ranks():
     """Update student ranks within departments based on CGPA"""
     try:
-        conn = sqlite3.connect('students.db')
-        cursor = conn.cursor()
-        
-        # Check column names in the students table
-        cursor.execute("PRAGMA table_info(students)")
-        columns = cursor.fetchall()
-        column_names = [col[1] for col in columns]
-        
-        # Check if department field exists
-        has_department = "department" in column_names
-        
-        # Determine which column to use for rank
-        rank_field = "college_rank" if "college_rank" in column_names else "rank"
-        
-        if has_department:
-            # Get all departments
-            cursor.execute("SELECT DISTINCT department FROM students")
-            departments = cursor.fetchall()
-            
-            for dept in departments:
-                department = dept[0]
-                # Get all students in this department sorted by CGPA in descending order
-                cursor.execute(f"""
-                    SELECT id, cgpa FROM students 
-                    WHERE department = ? 
-                    ORDER BY cgpa DESC, name ASC
-                """, (department,))
-                student_rows = cursor.fetchall()
-                
-                # Update ranks based on sorted order within department
-                for rank, (student_id, _) in enumerate(student_rows, 1):
-                    cursor.execute(f"UPDATE students SET {rank_field} = ? WHERE id = ?", (rank, student_id))
-        else:
-            # If no department field, rank all students together
-            cursor.execute("""
-                SELECT id, cgpa FROM students 
-                ORDER BY cgpa DESC, name ASC
-            """)
-            student_rows = cursor.fetchall()
-            
-            # Update ranks based on sorted order
-            for rank, (student_id, _) in enumerate(student_rows, 1):
-                cursor.execute(f"UPDATE students SET {rank_field} = ? WHERE id = ?", (rank, student_id))
-        
-        conn.commit()
-        conn.close()
-        logger.info("Updated ranks for students")
-        return True
+        # Immediate, like rank_backend's refresh, so the two never interleave
+        with student_db.transaction(immediate=True) as cursor:
+            # College-wide ranks, plus ranks within each department if there is one, each in
+            # one set-based statement. rebuild_ranks also clears the rank_changes log, which
+            # ranking.refresh_ranks would otherwise apply again on top of the fresh ranks
+            rebuild_ranks(cursor, "college_rank")
+        
+            logger.info("Updated ranks for students")
+            return True
     except Exception as e:
         logger.error(f"Error updating student ranks: {str(e)}")
         return False
@@ -752,7 +547,7 @@ async def process_scholarship_emails():
     Accepts both GET and POST so that the UI triggering a GET request can also work.
     """
     try:
-        check_and_process_emails()
+        await run_blocking(check_and_process_emails)
         return JSONResponse(status_code=200, content={"message": "Scholarship certificate processing complete"})
     except Exception as e:
         logger.error(f"Error in processing emails: {str(e)}")
@@ -765,9 +560,9 @@ async def update_scholarship_criteria(new_min_cgpa: float = None, new_min_attend
     Accepts optional new_min_cgpa and new_min_attendance values.
     """
     try:
-        if update_criteria(new_min_cgpa, new_min_attendance):
-            update_scholarship_eligibility()
-            return JSONResponse(status_code=200, content={"message": "Scholarship criteria updated"})
+        changed = await run_blocking(update_criteria, new_min_cgpa, new_min_attendance)
+        if changed is not None:
+            return JSONResponse(status_code=200, content={"message": "Scholarship criteria updated", "rows_changed": changed})
         else:
             raise Exception("Criteria update failed")
     except Exception as e:
@@ -780,7 +575,7 @@ async def update_student_ranks_endpoint():
     Endpoint to update student ranks within departments.
     """
     try:
-        if update_student_ranks():
+        if await run_blocking(update_student_ranks):
             return JSONResponse(status_code=200, content={"message": "Student ranks updated"})
         else:
             raise Exception("Rank update failed")
@@ -794,7 +589,7 @@ async def get_current_criteria():
     Endpoint to fetch current scholarship eligibility criteria.
     """
     try:
-        criteria = get_scholarship_criteria()
+        criteria = await run_blocking(get_scholarship_criteria)
         return JSONResponse(status_code=200, content={"min_cgpa": criteria[0], "min_attendance": criteria[1]})
     except Exception as e:
         logger.error(f"Error retrieving scholarship criteria: {str(e)}")
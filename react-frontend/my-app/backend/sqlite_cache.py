@@ -0,0 +1,52 @@
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteCache:
+    """
+    One size-bounded cache table in its own SQLite file (see llm_cache and mail_cache).
+
+    `create_tables(conn)` creates the table and its indexes; the table needs `size` and
+    `last_access` columns, which eviction uses to drop the least recently used rows.
+    """
+
+    def __init__(self, path, table, create_tables, max_bytes, label):
+        self.path = path
+        self.table = table
+        self.max_bytes = max_bytes
+        self.label = label
+        self._create_tables = create_tables
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        # The cache file keeps its tables, so this process only needs to create them once
+        if not self._schema_ready:
+            with self._schema_lock:
+                if not self._schema_ready:
+                    self._create_tables(conn)
+                    conn.commit()
+                    self._schema_ready = True
+        return conn
+
+    def evict(self, conn):
+        """Delete the least recently used rows while the table is over max_bytes."""
+        total = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Trim to 90% so eviction is not triggered again by the very next insert
+        target = int(self.max_bytes * 0.9)
+        freed = 0
+        victims = []
+        for rowid, size in conn.execute(f"SELECT rowid, size FROM {self.table} ORDER BY last_access"):
+            if total - freed <= target:
+                break
+            victims.append((rowid,))
+            freed += size
+        conn.executemany(f"DELETE FROM {self.table} WHERE rowid = ?", victims)
+        conn.commit()
+        logger.info(f"Evicted {len(victims)} cached {self.label} ({freed} bytes)")
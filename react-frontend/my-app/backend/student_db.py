@@ -0,0 +1,134 @@
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+from metrics import timed
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+STUDENT_DB_PATH          = os.environ.get("STUDENT_DB_PATH", "students.db")
+SQLITE_BUSY_TIMEOUT      = int(os.environ.get("SQLITE_BUSY_TIMEOUT", "5000"))         # ms to wait for a lock before failing
+SQLITE_SYNCHRONOUS       = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL").upper()     # NORMAL is crash-safe under WAL
+SQLITE_CACHED_STATEMENTS = int(os.environ.get("SQLITE_CACHED_STATEMENTS", "256"))   # prepared statements kept per connection
+
+# Most roll numbers bound in one IN (...) query; old SQLite builds allow 999 parameters
+MAX_LOOKUP_CHUNK = 512
+
+_local = threading.local()
+_connections = []   # (thread, connection), so shutdown can close them all
+_dedicated = []     # connections from open_connection(), closed at shutdown too
+_connections_lock = threading.Lock()
+
+
+def _open():
+    # check_same_thread is off only so close_all_connections() can close them; each is used by one thread
+    conn = sqlite3.connect(
+        STUDENT_DB_PATH,
+        timeout=SQLITE_BUSY_TIMEOUT / 1000,
+        cached_statements=SQLITE_CACHED_STATEMENTS,
+        check_same_thread=False,
+    )
+    # WAL lets the admin endpoints read while the inbox scan writes, and the setting persists in the file
+    mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    if mode.lower() != "wal":
+        logger.warning(f"Could not switch {STUDENT_DB_PATH} to WAL, journal mode is {mode}")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    return conn
+
+
+def open_connection():
+    """
+    A new, tuned connection outside the per-thread pool, for a caller that needs one of its own
+    (e.g. to hold a read transaction open across several queries without tying up a pooled one).
+    The caller serialises access to it; it is closed by close_all_connections().
+    """
+    conn = _open()
+    with _connections_lock:
+        _dedicated.append(conn)
+    return conn
+
+
+def get_connection():
+    """This thread's connection to students.db, opened and tuned on first use and reused afterwards."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _open()
+        _local.conn = conn
+        with _connections_lock:
+            # Threads that have exited no longer need theirs
+            for thread, old in [entry for entry in _connections if not entry[0].is_alive()]:
+                old.close()
+                _connections.remove((thread, old))
+            _connections.append((threading.current_thread(), conn))
+    return conn
+
+
+def cursor():
+    """A cursor on this thread's connection, for reads."""
+    return get_connection().cursor()
+
+
+@contextmanager
+def transaction(immediate=False):
+    """
+    Yield a cursor whose writes are committed together when the block ends, or rolled back if it raises.
+
+    With immediate=True the write lock is taken up front, so what the block reads can't change
+    under it before it writes (read-modify-write of shared state).
+    """
+    conn = get_connection()
+    try:
+        if immediate:
+            conn.execute("BEGIN IMMEDIATE")
+        yield conn.cursor()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def _padded_size(count):
+    # Round up to a power of two, so the statement cache sees a handful of IN (...) shapes
+    size = 1
+    while size < count:
+        size *= 2
+    return size
+
+
+@timed("db_verify")
+def get_students(roll_nos):
+    """
+    Return {roll_no: row as a dict} for every roll number found in the students table.
+
+    All roll numbers are resolved with one `roll_no IN (...)` query per MAX_LOOKUP_CHUNK,
+    and the rows carry every column, so later steps (PDF rendering) need no further query.
+    """
+    roll_nos = list(dict.fromkeys(str(roll_no) for roll_no in roll_nos if roll_no))
+    cursor = get_connection().cursor()
+    cursor.row_factory = sqlite3.Row
+    found = {}
+    for start in range(0, len(roll_nos), MAX_LOOKUP_CHUNK):
+        chunk = roll_nos[start:start + MAX_LOOKUP_CHUNK]
+        # Padding with NULLs matches nothing
+        params = chunk + [None] * (_padded_size(len(chunk)) - len(chunk))
+        cursor.execute(f"SELECT * FROM students WHERE roll_no IN ({','.join('?' * len(params))})", params)
+        found.update({row["roll_no"]: dict(row) for row in cursor.fetchall()})
+    return found
+
+
+def close_all_connections():
+    with _connections_lock:
+        for conn in [conn for _, conn in _connections] + _dedicated:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+        _dedicated.clear()
+    _local.__dict__.clear()